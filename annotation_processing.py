@@ -1,24 +1,171 @@
 # annotation_processing.py (updated with mask smoothing)
 import cv2
 import numpy as np
+from timing import stage
 
-def create_mask_annotation(mask):
-    contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    polygon = []
-    for contour in contours:
-        contour = contour.squeeze()
-        if len(contour) >= 3:
-            polygon.extend(contour.tolist())
-    return polygon
+# Defaults for the polygon simplification stage (pixels / vertices / square pixels)
+SIMPLIFY_TOLERANCE = 1.0
+SIMPLIFY_MAX_VERTICES = None
+MIN_FRAGMENT_AREA = 16.0
+
+class Annotation:
+    """One object: its contours as separate (N, 2) int32 arrays plus a class id.
+
+    holes are optional inner rings (only kept when asked for). bbox and area are
+    computed once on first use and cached; contours are not modified in place
+    after construction.
+    """
+    __slots__ = ('contours', 'holes', 'class_id', 'db_id', '_bbox', '_area')
+
+    def __init__(self, contours, class_id=0, db_id=None, holes=None):
+        self.contours = [as_contour(c) for c in contours]
+        self.holes = [as_contour(c) for c in holes] if holes else []
+        self.class_id = class_id
+        self.db_id = db_id
+        self._bbox = None
+        self._area = None
+
+    def __bool__(self):
+        return bool(self.contours)
+
+    @property
+    def bbox(self):
+        if self._bbox is None:
+            self._bbox = polygon_bbox(self.points())
+        return self._bbox
+
+    @property
+    def area(self):
+        if self._area is None:
+            self._area = float(sum(polygon_area(c) for c in self.contours) -
+                               sum(polygon_area(c) for c in self.holes))
+        return self._area
+
+    @property
+    def vertex_count(self):
+        return sum(len(c) for c in self.contours) + sum(len(c) for c in self.holes)
+
+    def points(self):
+        # All contours stacked, for consumers that take a single point list
+        if len(self.contours) == 1:
+            return self.contours[0]
+        return np.concatenate(self.contours) if self.contours else np.empty((0, 2), np.int32)
+
+    def scaled(self, sx, sy, holes=False):
+        rings = self.contours + self.holes if holes else self.contours
+        return [c / (sx, sy) for c in rings]
+
+    def normalized(self, w, h):
+        # One ring for formats with a single polygon per object (YOLO)
+        return (merge_contours(self.contours) / (w, h)).ravel()
+
+def as_contour(points):
+    return np.ascontiguousarray(points, dtype=np.int32).reshape(-1, 2)
+
+def merge_contours(contours):
+    """Joins several contours into one ring without adding area.
+
+    Same idea as Ultralytics' merge_multi_segment: consecutive contours are
+    linked at their closest pair of points and each link is walked once out
+    and once back, so the bridges have zero width.
+    """
+    if len(contours) <= 1:
+        return contours[0] if contours else np.empty((0, 2), np.int32)
+    links = [_closest_points(a, b) for a, b in zip(contours, contours[1:])]
+    last = len(contours) - 1
+    forward = [_loop(contours[0], links[0][0])]
+    back = []
+    for k in range(1, last):
+        entry, exit = links[k - 1][1], links[k][0]
+        forward.append(_arc(contours[k], entry, exit))
+        back.append(_arc(contours[k], exit, entry) if exit != entry else _loop(contours[k], exit))
+    forward.append(_loop(contours[last], links[-1][1]))
+    return np.concatenate(forward + back[::-1])
+
+def _closest_points(a, b, chunk=1024):
+    # Indices of the closest pair between two contours; chunked so long
+    # contours do not need a len(a) x len(b) distance matrix at once
+    best = (np.inf, 0, 0)
+    b = b.astype(np.int64)
+    for start in range(0, len(a), chunk):
+        d = ((a[start:start + chunk, None].astype(np.int64) - b[None]) ** 2).sum(axis=2)
+        i, j = np.unravel_index(np.argmin(d), d.shape)
+        if d[i, j] < best[0]:
+            best = (d[i, j], start + i, j)
+    return int(best[1]), int(best[2])
+
+def _arc(contour, start, stop):
+    # Vertices from start to stop (inclusive) walking forward around the ring
+    if stop >= start:
+        return contour[start:stop + 1]
+    return np.concatenate([contour[start:], contour[:stop + 1]])
+
+def _loop(contour, start):
+    # The whole ring starting and ending at start
+    return np.concatenate([contour[start:], contour[:start + 1]])
+
+def create_mask_annotation(mask, class_id=0, keep_holes=False, min_area=0.0):
+    with stage('create_mask_annotation', shape=mask.shape) as fields:
+        mode = cv2.RETR_CCOMP if keep_holes else cv2.RETR_EXTERNAL
+        contours, hierarchy = cv2.findContours(mask.astype(np.uint8), mode, cv2.CHAIN_APPROX_SIMPLE)
+        kept, holes = [], []
+        for i, contour in enumerate(contours):
+            contour = contour.reshape(-1, 2)
+            if len(contour) < 3 or (min_area and cv2.contourArea(contour) < min_area):
+                continue
+            # With RETR_CCOMP, contours that have a parent are the holes of that parent
+            if keep_holes and hierarchy[0][i][3] >= 0:
+                holes.append(contour)
+            else:
+                kept.append(contour)
+        fields['contours'] = len(kept)
+        return Annotation(kept, class_id, holes=holes)
+
+def _approx(contour, epsilon):
+    return cv2.approxPolyDP(contour.reshape(-1, 1, 2), epsilon, True).reshape(-1, 2)
+
+def simplify_contour(contour, tolerance=None, max_vertices=None):
+    # Douglas-Peucker (cv2.approxPolyDP); for a vertex budget the tolerance is
+    # found by bisection.
+    result = _approx(contour, tolerance) if tolerance else contour
+    if max_vertices is not None and len(result) > max_vertices:
+        lo = tolerance or 0.0
+        hi = max(1.0, cv2.arcLength(contour.reshape(-1, 1, 2), True))
+        for _ in range(20):
+            mid = (lo + hi) / 2
+            if len(_approx(contour, mid)) > max_vertices:
+                lo = mid
+            else:
+                hi = mid
+        result = _approx(contour, hi)
+    return result if len(result) >= 3 else contour
+
+def simplify_annotation(annotation, tolerance=SIMPLIFY_TOLERANCE, max_vertices=SIMPLIFY_MAX_VERTICES,
+                        min_area=MIN_FRAGMENT_AREA):
+    """Returns (simplified annotation, vertex count before, vertex count after)."""
+    def simplify_rings(rings):
+        return [simplify_contour(c, tolerance, max_vertices) for c in rings
+                if not min_area or polygon_area(c) >= min_area]
+
+    simplified = Annotation(simplify_rings(annotation.contours), annotation.class_id,
+                            annotation.db_id, holes=simplify_rings(annotation.holes))
+    return simplified, annotation.vertex_count, simplified.vertex_count
+
+def mask_to_annotation(mask, class_id=0, keep_holes=False, tolerance=SIMPLIFY_TOLERANCE,
+                       max_vertices=SIMPLIFY_MAX_VERTICES, min_area=MIN_FRAGMENT_AREA):
+    """Mask -> simplified Annotation; returns (annotation, vertices before, vertices after)."""
+    annotation = create_mask_annotation(mask, class_id, keep_holes, min_area)
+    return simplify_annotation(annotation, tolerance, max_vertices, min_area)
+
+def polygon_bbox(polygon):
+    points = np.asarray(polygon).reshape(-1, 2)
+    return points.min(axis=0).tolist() + points.max(axis=0).tolist()
+
+def polygon_area(polygon):
+    # Shoelace formula
+    points = np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+    x, y = points[:, 0], points[:, 1]
+    return 0.5 * abs(np.dot(x, np.roll(y, 1)) - np.dot(y, np.roll(x, 1)))
 
 def polygons_to_bboxes(polygons):
-    bboxes = []
-    for polygon in polygons:
-        x_coords = [p[0] for p in polygon]
-        y_coords = [p[1] for p in polygon]
-        x_min = min(x_coords)
-        y_min = min(y_coords)
-        x_max = max(x_coords)
-        y_max = max(y_coords)
-        bboxes.append([x_min, y_min, x_max, y_max])
-    return bboxes
\ No newline at end of file
+    return [polygon_bbox(polygon) for polygon in polygons]
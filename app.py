@@ -1,12 +1,38 @@
 # app.py (main entry point)
+import argparse
 import tkinter as tk
 from tkinter import filedialog
 from gui import MainApplication
 from dataset_export import export_yolo_dataset
+from timing import enable_timing_log
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Smart Polygon Annotator")
+    parser.add_argument("--embedding-store", default=None,
+                        help="Directory written by precompute_embeddings.py")
+    parser.add_argument("--project", default=None,
+                        help="Project file (SQLite); created if missing, edits are saved as you go")
+    parser.add_argument("--device", default=None, help="cpu or cuda (default: cuda if available)")
+    parser.add_argument("--quantize", action="store_true",
+                        help="int8 dynamic quantization of the image encoder (CPU only)")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--server", default=None,
+                        help="Use a shared inference_server.py (e.g. 127.0.0.1:8765) instead of a local model")
+    parser.add_argument("--timing-log", default=None, metavar="PATH",
+                        help="Write per-stage timings as JSON lines to PATH ('-' for stderr)")
+    parser.add_argument("--show-timings", action="store_true",
+                        help="Show the latest per-stage timings in the status bar")
+    args = parser.parse_args()
+    if args.timing_log:
+        enable_timing_log(None if args.timing_log == '-' else args.timing_log)
+    model_options = {'quantize': args.quantize, 'num_threads': args.threads}
+    if args.device:
+        model_options['device'] = args.device
+
     root = tk.Tk()
     root.title("Smart Polygon Annotator")
     root.geometry("1280x1280")
-    app = MainApplication(root)
-    root.mainloop()
\ No newline at end of file
+    app = MainApplication(root, embedding_store=args.embedding_store,
+                          project=args.project, model_options=model_options, server=args.server,
+                          show_timings=args.show_timings)
+    root.mainloop()
@@ -0,0 +1,109 @@
+# auto_annotate.py (headless pre-labeling: SAM "segment everything" over a directory into a project)
+import os
+import time
+import argparse
+import multiprocessing
+from project_store import ProjectStore
+from dataset_export import export_yolo_dataset
+from precompute_embeddings import find_images
+from annotation_processing import (mask_to_annotation, SIMPLIFY_TOLERANCE, SIMPLIFY_MAX_VERTICES,
+                                   MIN_FRAGMENT_AREA)
+
+_generator = None
+_mask_options = None
+
+
+def init_worker(device, threads, points_per_side, points_per_batch, mask_options):
+    # One SAM model and mask generator per worker process
+    global _generator, _mask_options
+    import torch
+    from segment_anything import SamAutomaticMaskGenerator
+    from sam_integration import load_sam_model
+    torch.set_num_threads(threads)
+    predictor = load_sam_model(device) if device else load_sam_model()
+    _generator = SamAutomaticMaskGenerator(predictor.model, points_per_side=points_per_side,
+                                           points_per_batch=points_per_batch)
+    _mask_options = mask_options
+
+
+def annotate_image(image_path):
+    from prefetch import load_image_array
+    start = time.perf_counter()
+    image = load_image_array(image_path)
+    decode_time = time.perf_counter() - start
+    annotations = []
+    for mask in _generator.generate(image):
+        annotation, _, _ = mask_to_annotation(mask['segmentation'], **_mask_options)
+        if annotation:
+            annotations.append(annotation)
+    return image_path, annotations, image.shape[1::-1], decode_time, time.perf_counter() - start
+
+
+def auto_annotate(image_dir, project, workers=1, threads=None, device=None, points_per_side=32,
+                  points_per_batch=64, class_id=0, class_name="object", mask_options=None):
+    store = ProjectStore(project)
+    image_paths = find_images(image_dir)
+    store.add_images(image_paths)
+    store.ensure_class(class_id, class_name)
+    done = store.auto_annotated_paths()
+    todo = [path for path in image_paths if path not in done]
+    print(f"{len(done)} images already processed, {len(todo)} to go")
+    if not todo:
+        return store
+    # Every worker loads its own model: never start more than there are images
+    workers = min(workers, len(todo))
+
+    mask_options = dict(mask_options or {}, class_id=class_id)
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+    ctx = multiprocessing.get_context("spawn")
+    total_start = time.perf_counter()
+    with ctx.Pool(workers, initializer=init_worker,
+                  initargs=(device, threads, points_per_side, points_per_batch, mask_options)) as pool:
+        for count, (image_path, annotations, size, decode_time, seconds) in enumerate(
+                pool.imap_unordered(annotate_image, todo), 1):
+            # One transaction per image: the image's masks and its done-marker
+            # land together, which is what makes the job resumable
+            with store.batch():
+                store.set_image_size(image_path, *size)
+                for annotation in annotations:
+                    store.add_annotation(image_path, annotation)
+                store.mark_auto_annotated(image_path, len(annotations), seconds)
+            print(f"[{count}/{len(todo)}] {image_path}: {len(annotations)} masks "
+                  f"in {seconds:.2f}s (decode {decode_time:.2f}s)")
+    elapsed = time.perf_counter() - total_start
+    print(f"Processed {len(todo)} images in {elapsed:.1f}s ({elapsed / len(todo):.2f}s per image)")
+    return store
+
+
+def export_project(store, export_dir):
+    class_names = {cid: info['name'] for cid, info in store.load_classes().items()}
+    stats = export_yolo_dataset(store.annotations_view(), export_dir, class_names, store.image_sizes())
+    print(f"Exported {stats['images']} images to {export_dir} ({stats['written']} written)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-label a directory of images with SAM automatic mask generation")
+    parser.add_argument("image_dir")
+    parser.add_argument("--project", required=True, help="Project file to create or resume (open it with app.py --project)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+    parser.add_argument("--threads-per-worker", type=int, default=None, help="torch intra-op threads per worker")
+    parser.add_argument("--device", default=None, help="cpu or cuda (default: auto)")
+    parser.add_argument("--points-per-side", type=int, default=32, help="Prompt grid density")
+    parser.add_argument("--points-per-batch", type=int, default=64, help="Prompts decoded per batch")
+    parser.add_argument("--class-id", type=int, default=0, help="Class assigned to every generated mask")
+    parser.add_argument("--class-name", default="object", help="Name for the class if the project lacks it")
+    parser.add_argument("--tolerance", type=float, default=SIMPLIFY_TOLERANCE, help="Polygon simplification tolerance in pixels")
+    parser.add_argument("--max-vertices", type=int, default=SIMPLIFY_MAX_VERTICES, help="Vertex budget per contour")
+    parser.add_argument("--min-area", type=float, default=MIN_FRAGMENT_AREA, help="Drop fragments smaller than this many pixels")
+    parser.add_argument("--export", default=None, help="Also export the project as a YOLO dataset into this directory")
+    args = parser.parse_args()
+    store = auto_annotate(args.image_dir, args.project, args.workers, args.threads_per_worker, args.device,
+                  args.points_per_side, args.points_per_batch, args.class_id, args.class_name,
+                  {'tolerance': args.tolerance, 'max_vertices': args.max_vertices, 'min_area': args.min_area})
+    if args.export:
+        export_project(store, args.export)
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
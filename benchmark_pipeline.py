@@ -0,0 +1,314 @@
+# benchmark_pipeline.py (click latency, undo memory and export throughput without a SAM checkpoint)
+import os
+import gc
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+from types import SimpleNamespace
+import cv2
+import numpy as np
+import torch
+from PIL import Image, ImageDraw
+from sam_integration import generate_masks
+from embedding_cache import EmbeddingCache
+from annotation_processing import (Annotation, mask_to_annotation, SIMPLIFY_TOLERANCE, SIMPLIFY_MAX_VERTICES,
+                                   MIN_FRAGMENT_AREA)
+from history import History, AddAnnotation, RelabelAnnotation
+from spatial_index import SpatialIndex
+from dataset_export import export_yolo_dataset
+from coco_export import export_coco_dataset
+from timing import timer
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+IMAGE_SIZE = (1024, 768)
+# Default density of the synthetic projects; --annotations-per-image changes it
+ANNOTATIONS_PER_IMAGE = 20
+# Same options the GUI applies to masks
+MASK_OPTIONS = {'keep_holes': False, 'tolerance': SIMPLIFY_TOLERANCE,
+                'max_vertices': SIMPLIFY_MAX_VERTICES, 'min_area': MIN_FRAGMENT_AREA}
+# Metrics where a larger value is better; for all others smaller is better
+HIGHER_IS_BETTER = ('_per_s',)
+
+
+def blob(rng, cx, cy, radius, vertices=48):
+    # Irregular star-shaped polygon, closer to a SAM mask outline than a circle
+    angles = np.sort(rng.uniform(0, 2 * np.pi, vertices))
+    radii = radius * rng.uniform(0.6, 1.0, vertices)
+    return np.stack([cx + radii * np.cos(angles), cy + radii * np.sin(angles)], axis=1).astype(np.int32)
+
+
+class StubPredictor:
+    """Stands in for a SamPredictor: synthetic masks around the clicked point.
+
+    encode_ms / decode_ms add sleeps so a real model's cost can be modelled;
+    with the defaults only the code around the model is measured.
+    """
+
+    def __init__(self, encode_ms=0.0, decode_ms=0.0, seed=0):
+        self.device = 'cpu'
+        self.encode_ms = encode_ms
+        self.decode_ms = decode_ms
+        self.rng = np.random.default_rng(seed)
+        self.reset_image()
+
+    def reset_image(self):
+        self.features = None
+        self.original_size = None
+        self.input_size = None
+        self.is_image_set = False
+
+    def set_image(self, image):
+        h, w = image.shape[:2]
+        scale = 1024 / max(h, w)
+        # Same shape as SAM's ViT embedding, so cache sizes are realistic
+        self.features = torch.zeros((1, 256, 64, 64))
+        self.original_size = (h, w)
+        self.input_size = (int(h * scale + 0.5), int(w * scale + 0.5))
+        self.is_image_set = True
+        if self.encode_ms:
+            time.sleep(self.encode_ms / 1000)
+
+    def predict(self, point_coords=None, point_labels=None, box=None, multimask_output=True):
+        h, w = self.original_size
+        cx, cy = point_coords[0]
+        mask = np.zeros((h, w), np.uint8)
+        cv2.fillPoly(mask, [blob(self.rng, cx, cy, self.rng.uniform(20, min(h, w) / 6))], 1)
+        if self.decode_ms:
+            time.sleep(self.decode_ms / 1000)
+        return mask[None].astype(bool), np.array([0.95], np.float32), None
+
+
+def synthetic_annotations(count, rng, size=IMAGE_SIZE):
+    w, h = size
+    anns = []
+    for _ in range(count):
+        radius = rng.uniform(8, 60)
+        anns.append(Annotation([blob(rng, rng.uniform(radius, w - radius), rng.uniform(radius, h - radius),
+                                     radius, vertices=24)], int(rng.integers(0, 5))))
+    return anns
+
+
+def image_path(index):
+    return f"image_{index:05d}.png"
+
+
+def group_by_image(annotations, per_image=ANNOTATIONS_PER_IMAGE):
+    # The project as the GUI holds it: consecutive runs of per_image annotations per image
+    return {image_path(i // per_image): annotations[i:i + per_image]
+            for i in range(0, len(annotations), per_image)}
+
+
+def render_preview(annotation, rgb=(255, 0, 0)):
+    # What MainApplication.create_mask_preview rasterizes, minus the Tk PhotoImage
+    x0, y0, x1, y1 = annotation.bbox
+    overlay = Image.new('RGBA', (x1 - x0 + 1, y1 - y0 + 1), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(overlay)
+    for contour in annotation.contours:
+        draw.polygon((contour - (x0, y0)).ravel().tolist(), fill=rgb + (50,), outline=rgb + (200,))
+    return overlay
+
+
+def percentiles(seconds):
+    ms = np.array(seconds) * 1000
+    return {'p50_ms': float(np.percentile(ms, 50)), 'p99_ms': float(np.percentile(ms, 99)),
+            'max_ms': float(ms.max())}
+
+
+def bench_clicks(existing, clicks, images, predictor, rng, per_image=ANNOTATIONS_PER_IMAGE):
+    """Click -> mask -> polygon -> preview -> overlap check -> history, on a project
+    that already holds the given annotations, per_image of them on each image.
+
+    The clicks go to the first `images` images in turn. As in the GUI, only the
+    clicked image's annotations are in the spatial index. The first click per
+    image is cold (the stub encoder runs); the rest hit the embedding cache.
+    """
+    w, h = IMAGE_SIZE
+    target = SimpleNamespace(annotations=group_by_image(existing, per_image), class_manager=None)
+    history = History()
+    index = SpatialIndex()
+    cache = EmbeddingCache(max_entries=None)
+    frames = [rng.integers(0, 256, (h, w, 3), dtype=np.uint8) for _ in range(images)]
+    cold, warm = [], []
+    for i in range(clicks):
+        image_index = i * images // clicks
+        image = frames[image_index]
+        path = image_path(image_index)
+        # Switching images re-syncs the index (draw_existing_annotations); not part of a click
+        index.sync(target.annotations.get(path, []))
+        first = f"bench:{image_index}" not in cache
+        point = np.array([[rng.uniform(0.1, 0.9) * w, rng.uniform(0.1, 0.9) * h]])
+        start = time.perf_counter()
+        masks = generate_masks(predictor, image, point, np.array([1]), cache=cache,
+                               cache_key=f"bench:{image_index}")
+        annotation, _, _ = mask_to_annotation(masks[0], **MASK_OPTIONS)
+        if annotation:
+            render_preview(annotation)
+            index.overlaps(annotation, 0.5)
+            history.execute(AddAnnotation(path, annotation), target)
+            index.add(annotation)
+        (cold if first else warm).append(time.perf_counter() - start)
+    return {'cold': percentiles(cold), 'warm': percentiles(warm)}
+
+
+def bench_undo_memory(annotations, per_image=ANNOTATIONS_PER_IMAGE):
+    # Only what the history and the annotation lists add is counted: the
+    # annotations themselves exist before the first snapshot
+    target = SimpleNamespace(annotations={}, class_manager=None)
+    history = History()
+    n = len(annotations)
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    for i, annotation in enumerate(annotations):
+        history.execute(AddAnnotation(image_path(i // per_image), annotation), target)
+    add_seconds = time.perf_counter() - start
+    after_add = tracemalloc.get_traced_memory()[0]
+    for i in range(n):
+        history.execute(RelabelAnnotation(image_path(i // per_image), i % per_image, 1), target)
+    after_relabel = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    while history.undo(target) is not None:
+        pass
+    undo_seconds = time.perf_counter() - start
+    after_undo = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {'add_bytes_per_command': (after_add - base) / n,
+            'relabel_bytes_per_command': (after_relabel - after_add) / n,
+            'retained_after_undo_bytes': after_undo - base,
+            'add_commands_per_s': n / add_seconds,
+            'undo_commands_per_s': 2 * n / undo_seconds}
+
+
+def write_images(directory, count):
+    # One tiny PNG, copied: export reads sizes from image_sizes and symlinks the files
+    first = os.path.join(directory, "image_00000.png")
+    Image.new('RGB', (8, 6)).save(first)
+    paths = [first]
+    for i in range(1, count):
+        path = os.path.join(directory, f"image_{i:05d}.png")
+        shutil.copyfile(first, path)
+        paths.append(path)
+    return paths
+
+
+def bench_export(annotations, workdir, coco_segmentation, per_image=ANNOTATIONS_PER_IMAGE):
+    n_images = -(-len(annotations) // per_image)
+    image_dir = os.path.join(workdir, "images")
+    os.makedirs(image_dir)
+    paths = write_images(image_dir, n_images)
+    by_image = {path: annotations[i * per_image:(i + 1) * per_image] for i, path in enumerate(paths)}
+    sizes = {path: IMAGE_SIZE for path in paths}
+
+    start = time.perf_counter()
+    export_yolo_dataset(by_image, os.path.join(workdir, "yolo"), image_sizes=sizes, link_mode='symlink')
+    yolo_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    # Second run finds nothing to write; this is the cost of the manifest check
+    export_yolo_dataset(by_image, os.path.join(workdir, "yolo"), image_sizes=sizes, link_mode='symlink')
+    yolo_incremental_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    export_coco_dataset(by_image, os.path.join(workdir, "coco.json"), image_sizes=sizes,
+                        segmentation=coco_segmentation)
+    coco_seconds = time.perf_counter() - start
+    n = len(annotations)
+    return {'yolo_annotations_per_s': n / yolo_seconds,
+            'yolo_incremental_annotations_per_s': n / yolo_incremental_seconds,
+            'coco_annotations_per_s': n / coco_seconds}
+
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(results, baseline, tolerance):
+    # Returns the metrics that got worse than the baseline by more than tolerance
+    current, previous = flatten(results), flatten(baseline)
+    regressions = []
+    for name, old in previous.items():
+        new = current.get(name)
+        if new is None or not old or name.startswith("stages."):
+            continue
+        change = (new - old) / abs(old)
+        if any(name.endswith(suffix) for suffix in HIGHER_IS_BETTER):
+            change = -change
+        if change > tolerance:
+            regressions.append((name, old, new, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Annotation pipeline benchmarks with a stub predictor")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="Project sizes (annotations) to benchmark")
+    parser.add_argument("--clicks", type=int, default=50, help="Clicks per project size")
+    parser.add_argument("--images", type=int, default=5, help="Images the clicks are spread over")
+    parser.add_argument("--annotations-per-image", type=int, default=ANNOTATIONS_PER_IMAGE,
+                        help="Density of the synthetic projects (existing annotations per image)")
+    parser.add_argument("--encode-ms", type=float, default=0.0, help="Simulated image encoder time")
+    parser.add_argument("--decode-ms", type=float, default=0.0, help="Simulated mask decoder time")
+    parser.add_argument("--coco-segmentation", choices=("polygon", "rle"), default="polygon")
+    parser.add_argument("--skip", nargs="*", default=[], choices=("clicks", "undo", "export"))
+    parser.add_argument("--output", default=None, help="Write the results as JSON")
+    parser.add_argument("--compare", default=None, help="Baseline JSON from an earlier --output")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed relative slowdown against the baseline before failing")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    predictor = StubPredictor(args.encode_ms, args.decode_ms, args.seed)
+    results = {}
+    for size in args.sizes:
+        annotations = synthetic_annotations(size, rng)
+        row = results[str(size)] = {}
+        if "clicks" not in args.skip:
+            row['clicks'] = bench_clicks(annotations, args.clicks, args.images, predictor, rng,
+                                         args.annotations_per_image)
+            print(f"{size:>7} annotations | click cold p50 {row['clicks']['cold']['p50_ms']:7.2f} ms  "
+                  f"warm p50 {row['clicks']['warm']['p50_ms']:7.2f} ms  p99 {row['clicks']['warm']['p99_ms']:7.2f} ms")
+        if "undo" not in args.skip:
+            row['undo'] = bench_undo_memory(annotations, args.annotations_per_image)
+            print(f"{size:>7} annotations | history {row['undo']['add_bytes_per_command']:7.0f} B/add  "
+                  f"{row['undo']['relabel_bytes_per_command']:7.0f} B/relabel  "
+                  f"undo {row['undo']['undo_commands_per_s']:9.0f} cmd/s")
+        if "export" not in args.skip:
+            workdir = tempfile.mkdtemp(prefix="smart_annotator_bench_")
+            try:
+                row['export'] = bench_export(annotations, workdir, args.coco_segmentation,
+                                             args.annotations_per_image)
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+            print(f"{size:>7} annotations | export YOLO {row['export']['yolo_annotations_per_s']:9.0f} ann/s  "
+                  f"(unchanged {row['export']['yolo_incremental_annotations_per_s']:9.0f})  "
+                  f"COCO {row['export']['coco_annotations_per_s']:9.0f} ann/s")
+    # Informational only: per-stage means from the instrumented code paths
+    results['stages'] = timer.summary()
+    for name, stats in sorted(results['stages'].items()):
+        print(f"  {name:<24} n={stats['count']:7d}  mean {stats['mean_ms']:8.3f} ms  max {stats['max_ms']:8.2f} ms")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for name, old, new, change in regressions:
+            print(f"REGRESSION {name}: {old:.4g} -> {new:.4g} ({change:+.0%})")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%}")
+
+
+if __name__ == "__main__":
+    main()
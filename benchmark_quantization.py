@@ -0,0 +1,97 @@
+# benchmark_quantization.py (int8 vs float SAM on CPU: encoder latency and mask agreement)
+import time
+import argparse
+import numpy as np
+import torch
+from sam_integration import load_sam_model
+from precompute_embeddings import find_images
+from prefetch import load_image_array
+
+
+def prompt_points(shape, count, rng):
+    # Points away from the border, where most objects are clicked
+    h, w = shape[:2]
+    return np.stack([rng.uniform(0.1, 0.9, count) * w, rng.uniform(0.1, 0.9, count) * h], axis=1)
+
+
+def mask_iou(a, b):
+    union = np.logical_or(a, b).sum()
+    return 1.0 if union == 0 else np.logical_and(a, b).sum() / union
+
+
+def encode(predictor, image):
+    start = time.perf_counter()
+    with torch.inference_mode():
+        predictor.set_image(image)
+    return time.perf_counter() - start
+
+
+def decode(predictor, points):
+    masks, start = [], time.perf_counter()
+    with torch.inference_mode():
+        for point in points:
+            mask, _, _ = predictor.predict(point_coords=point[None], point_labels=np.array([1]),
+                                           multimask_output=False)
+            masks.append(mask[0])
+    return masks, (time.perf_counter() - start) / max(1, len(points))
+
+
+def state_dict_bytes(model):
+    # Quantized Linear layers store (weight, bias) tuples as packed params
+    total = 0
+    for value in model.state_dict().values():
+        for tensor in value if isinstance(value, (tuple, list)) else (value,):
+            if isinstance(tensor, torch.Tensor):
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare int8-quantized and float SAM on CPU")
+    parser.add_argument("image_dir")
+    parser.add_argument("--images", type=int, default=10, help="Number of images to sample")
+    parser.add_argument("--points", type=int, default=8, help="Click prompts per image")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    models = {}
+    for name, quantize in (("float32", False), ("int8", True)):
+        start = time.perf_counter()
+        models[name] = load_sam_model("cpu", quantize=quantize, num_threads=args.threads)
+        print(f"{name}: loaded in {time.perf_counter() - start:.1f}s, "
+              f"{state_dict_bytes(models[name].model) / 2**20:.0f} MB of weights")
+
+    encode_times = {name: [] for name in models}
+    decode_times = {name: [] for name in models}
+    ious = []
+    for image_path in find_images(args.image_dir)[:args.images]:
+        image = load_image_array(image_path)
+        points = prompt_points(image.shape, args.points, rng)
+        masks = {}
+        for name, predictor in models.items():
+            encode_times[name].append(encode(predictor, image))
+            masks[name], per_click = decode(predictor, points)
+            decode_times[name].append(per_click)
+        image_ious = [mask_iou(a, b) for a, b in zip(masks["float32"], masks["int8"])]
+        ious.extend(image_ious)
+        print(f"{image_path}: encode {encode_times['float32'][-1]:.2f}s -> {encode_times['int8'][-1]:.2f}s, "
+              f"mean IoU {np.mean(image_ious):.3f}")
+
+    if not ious:
+        print("No images found")
+        return
+    print()
+    print(f"{'':10}{'encode p50':>12}{'encode mean':>13}{'decode/click':>14}")
+    for name in models:
+        print(f"{name:10}{np.median(encode_times[name]):>11.2f}s{np.mean(encode_times[name]):>12.2f}s"
+              f"{np.mean(decode_times[name]) * 1000:>12.1f}ms")
+    speedup = np.mean(encode_times["float32"]) / np.mean(encode_times["int8"])
+    print(f"\nEncoder speedup: {speedup:.2f}x")
+    print(f"Mask IoU int8 vs float32 over {len(ious)} clicks: mean {np.mean(ious):.3f}, "
+          f"p5 {np.percentile(ious, 5):.3f}, min {np.min(ious):.3f}")
+
+
+if __name__ == "__main__":
+    main()
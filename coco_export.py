@@ -0,0 +1,120 @@
+# coco_export.py (streaming COCO instance-segmentation export with polygon or RLE masks)
+import os
+import json
+import time
+import shutil
+import tempfile
+import datetime
+import cv2
+import numpy as np
+from dataset_export import read_image_size, simplify_annotations
+from timing import timer
+
+SEGMENTATION_FORMATS = ('polygon', 'rle')
+# COCO category ids start at 1 (0 is read as background by most tools), while
+# annotator class ids start at 0: category_id = class_id + CATEGORY_ID_OFFSET
+CATEGORY_ID_OFFSET = 1
+
+def rle_counts(contours, w, h, holes=None):
+    # Column-major run lengths of the filled contours. Only the columns spanned by
+    # their bbox are rasterized; the all-zero columns around it are added as
+    # plain counts, so memory depends on the object and not the image.
+    contours = [np.clip(c, (0, 0), (w - 1, h - 1)).astype(np.int32) for c in contours]
+    x0 = min(int(c[:, 0].min()) for c in contours)
+    x1 = max(int(c[:, 0].max()) for c in contours) + 1
+    local = np.zeros((h, x1 - x0), dtype=np.uint8)
+    cv2.fillPoly(local, [c - (x0, 0) for c in contours], 1)
+    if holes:
+        holes = [np.clip(c, (0, 0), (w - 1, h - 1)).astype(np.int32) for c in holes]
+        cv2.fillPoly(local, [c - (x0, 0) for c in holes], 0)
+    flat = local.ravel(order='F')
+
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [flat.size]))).tolist()
+    if flat[0]:
+        counts.insert(0, 0)
+    counts[0] += int(x0) * h
+    trailing = (w - int(x1)) * h
+    if len(counts) % 2 == 1:
+        counts[-1] += trailing
+    elif trailing:
+        counts.append(trailing)
+    return counts
+
+def rle_to_string(counts):
+    # COCO's compressed RLE string encoding (same as pycocotools' rleToString)
+    chars = []
+    for i, x in enumerate(counts):
+        if i > 2:
+            x -= counts[i - 2]
+        more = True
+        while more:
+            c = x & 0x1f
+            x >>= 5
+            more = (x != -1) if (c & 0x10) else (x != 0)
+            if more:
+                c |= 0x20
+            chars.append(chr(c + 48))
+    return ''.join(chars)
+
+def encode_segmentation(ann, w, h, segmentation):
+    if segmentation == 'rle':
+        return {'size': [h, w], 'counts': rle_to_string(rle_counts(ann.contours, w, h, ann.holes))}
+    # Polygon segmentations cannot express holes; use RLE to keep them
+    return [c.ravel().tolist() for c in ann.contours]
+
+def export_coco_dataset(annotations, output_path, class_names=None, image_sizes=None,
+                        segmentation='polygon', simplify=None):
+    if segmentation not in SEGMENTATION_FORMATS:
+        raise ValueError(f"segmentation must be one of {SEGMENTATION_FORMATS}")
+    if not class_names:
+        class_names = {0: 'object'}
+    start = time.perf_counter()
+
+    # Annotations are streamed straight into the output and image entries into a
+    # spool file that is appended at the end, so nothing is accumulated per image.
+    with open(output_path, 'w') as out, tempfile.TemporaryFile('w+') as images_spool:
+        out.write('{"info": ' + json.dumps({
+            'description': 'Smart Polygon Annotator export',
+            'date_created': datetime.datetime.now().isoformat(timespec='seconds'),
+        }))
+        out.write(', "categories": ' + json.dumps(
+            [{'id': cid + CATEGORY_ID_OFFSET, 'name': class_names[cid]} for cid in sorted(class_names)]))
+        out.write(', "annotations": [')
+
+        ann_id = vertices_before = vertices_after = 0
+        for image_id, image_path in enumerate(annotations, 1):
+            if image_sizes and image_path in image_sizes:
+                w, h = image_sizes[image_path]
+            else:
+                w, h = read_image_size(image_path)
+            images_spool.write((',' if image_id > 1 else '') + json.dumps({
+                'id': image_id, 'file_name': os.path.basename(image_path),
+                'width': w, 'height': h}))
+
+            anns, before, after = simplify_annotations(annotations[image_path], simplify)
+            vertices_before += before
+            vertices_after += after
+            for ann in anns:
+                if not ann:
+                    continue
+                x_min, y_min, x_max, y_max = ann.bbox
+                ann_id += 1
+                out.write((',' if ann_id > 1 else '') + json.dumps({
+                    'id': ann_id,
+                    'image_id': image_id,
+                    'category_id': ann.class_id + CATEGORY_ID_OFFSET,
+                    'segmentation': encode_segmentation(ann, w, h, segmentation),
+                    'area': ann.area,
+                    'bbox': [x_min, y_min, x_max - x_min, y_max - y_min],
+                    'iscrowd': 0,
+                }))
+
+        out.write('], "images": [')
+        images_spool.seek(0)
+        shutil.copyfileobj(images_spool, out)
+        out.write(']}\n')
+    stats = {'annotations': ann_id, 'vertices_before': vertices_before,
+             'vertices_after': vertices_after}
+    timer.record('export_coco', time.perf_counter() - start, segmentation=segmentation, **stats)
+    return stats
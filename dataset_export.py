@@ -1,26 +1,146 @@
 # dataset_export.py
 import os
+import json
+import time
 import shutil
+import hashlib
 import yaml
-import random
-from sklearn.model_selection import train_test_split
-from PIL import Image
+from annotation_processing import simplify_annotation
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from image_cache import open_unchecked
+from timing import timer
+
+SPLITS = ['train', 'val', 'test']
+SPLIT_RATIOS = [0.80, 0.15, 0.05]
+MANIFEST_FILE = '.export_manifest.json'
+LINK_MODES = ('copy', 'hardlink', 'symlink')
+
+def assign_split(image_path):
+    # Hash of the file name: stable across re-exports and independent of the other images
+    digest = hashlib.sha1(os.path.basename(image_path).encode('utf-8')).digest()
+    u = int.from_bytes(digest[:8], 'big') / 2**64
+    cumulative = 0.0
+    for split, ratio in zip(SPLITS, SPLIT_RATIOS):
+        cumulative += ratio
+        if u < cumulative:
+            return split
+    return SPLITS[-1]
+
+def read_image_size(image_path):
+    # Only the header is parsed and pixels are never decoded, so this also
+    # works for images above PIL's decompression bomb limit
+    with open_unchecked(image_path) as img:
+        return img.size
+
+def file_signature(path):
+    st = os.stat(path)
+    return f"{st.st_mtime_ns}:{st.st_size}"
+
+def format_yolo_labels(anns, w, h):
+    lines = []
+    for ann in anns:
+        if not ann:
+            continue
+        normalized = ann.normalized(w, h)
+        lines.append(f"{ann.class_id} " + " ".join(f"{c:.6f}" for c in normalized))
+    return "".join(line + "\n" for line in lines)
+
+def place_image(src, dest, link_mode='copy'):
+    if os.path.lexists(dest):
+        os.remove(dest)
+    if link_mode == 'hardlink':
+        try:
+            os.link(src, dest)
+            return
+        except OSError:
+            pass  # different filesystem: fall back to copying
+    elif link_mode == 'symlink':
+        os.symlink(os.path.abspath(src), dest)
+        return
+    shutil.copy(src, dest)
+
+def load_manifest(export_dir):
+    path = os.path.join(export_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+def save_manifest(export_dir, manifest):
+    path = os.path.join(export_dir, MANIFEST_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+
+def simplify_annotations(anns, simplify):
+    # Returns the annotations to write plus their vertex counts before/after. Opt-in:
+    # masks are simplified when they are created, so the default exports them as kept
+    if simplify is None:
+        count = sum(ann.vertex_count for ann in anns)
+        return anns, count, count
+    simplified, before, after = [], 0, 0
+    for ann in anns:
+        ann, b, a = simplify_annotation(ann, **simplify)
+        simplified.append(ann)
+        before += b
+        after += a
+    return simplified, before, after
+
+def export_image(image_path, anns, export_dir, previous, image_sizes, link_mode, simplify=None):
+    split = assign_split(image_path)
+    img_name = os.path.basename(image_path)
+    dest_img = os.path.join(export_dir, split, 'images', img_name)
+    txt_path = os.path.join(export_dir, split, 'labels', os.path.splitext(img_name)[0] + '.txt')
+    signature = file_signature(image_path)
+
+    if image_sizes and image_path in image_sizes:
+        w, h = image_sizes[image_path]
+    elif previous and previous['signature'] == signature:
+        w, h = previous['size']
+    else:
+        w, h = read_image_size(image_path)
+
+    anns, vertices_before, vertices_after = simplify_annotations(anns, simplify)
+    labels = format_yolo_labels(anns, w, h)
+    label_hash = hashlib.sha1(labels.encode('utf-8')).hexdigest()
+    entry = {'split': split, 'name': img_name, 'signature': signature,
+             'size': [w, h], 'label_hash': label_hash, 'link_mode': link_mode}
+
+    same_place = previous is not None and previous['split'] == split and previous['name'] == img_name
+    wrote = False
+    if not (same_place and previous['signature'] == signature
+            and previous.get('link_mode') == link_mode and os.path.lexists(dest_img)):
+        place_image(image_path, dest_img, link_mode)
+        wrote = True
+    if not (same_place and previous['label_hash'] == label_hash and os.path.exists(txt_path)):
+        with open(txt_path, 'w') as f:
+            f.write(labels)
+        wrote = True
+    return image_path, entry, wrote, vertices_before, vertices_after
+
+def remove_exported(export_dir, entry):
+    img_path = os.path.join(export_dir, entry['split'], 'images', entry['name'])
+    txt_path = os.path.join(export_dir, entry['split'], 'labels',
+                            os.path.splitext(entry['name'])[0] + '.txt')
+    for path in (img_path, txt_path):
+        if os.path.lexists(path):
+            os.remove(path)
+
+def export_yolo_dataset(annotations, export_dir, class_names=None, image_sizes=None,
+                        link_mode='copy', workers=8, simplify=None):
+    if link_mode not in LINK_MODES:
+        raise ValueError(f"link_mode must be one of {LINK_MODES}")
+    start = time.perf_counter()
 
-def export_yolo_dataset(annotations, export_dir, class_names=None):
     # Create directories
-    splits = ['train', 'val', 'test']
-    for split in splits:
+    for split in SPLITS:
         os.makedirs(os.path.join(export_dir, split, 'images'), exist_ok=True)
         os.makedirs(os.path.join(export_dir, split, 'labels'), exist_ok=True)
-    
-    # Prepare data
-    image_paths = list(annotations.keys())
-    random.shuffle(image_paths)
-    
-    # Split dataset
-    train_val, test = train_test_split(image_paths, test_size=0.05, random_state=42)
-    train, val = train_test_split(train_val, test_size=0.15/0.95, random_state=42)
-    
+
     # Create YAML config
     if class_names:
         names = [class_names[cid] for cid in sorted(class_names)]
@@ -28,7 +148,7 @@ def export_yolo_dataset(annotations, export_dir, class_names=None):
     else:
         names = ['object']
         nc = 1
-    
+
     data_yaml = {
         'names': names,
         'nc': nc,
@@ -36,25 +156,44 @@ def export_yolo_dataset(annotations, export_dir, class_names=None):
         'train': 'train/images',
         'val': 'val/images'
     }
-    
-    # Process splits
-    for split_name, split_data in zip(splits, [train, val, test]):
-        for image_path in split_data:
-            img_name = os.path.basename(image_path)
-            dest_img = os.path.join(export_dir, split_name, 'images', img_name)
-            shutil.copy(image_path, dest_img)
-            
-            txt_path = os.path.join(export_dir, split_name, 'labels', 
-                                  os.path.splitext(img_name)[0] + '.txt')
-            with open(txt_path, 'w') as f:
-                img = Image.open(image_path)
-                w, h = img.size
-                for ann in annotations[image_path]:
-                    poly = ann['polygon']
-                    class_id = ann['class_id']
-                    normalized = [x/w if i%2==0 else y/h for i, (x,y) in enumerate(poly)]
-                    f.write(f"{class_id} " + " ".join(f"{c:.6f}" for c in normalized) + "\n")
-    
+
+    # Only images whose file, split or labels changed since the last export are written
+    previous = load_manifest(export_dir)
+    manifest = {}
+    written = vertices_before = vertices_after = 0
+    # Bounded number of jobs in flight, so a lazily loaded annotations mapping
+    # never has to be materialized all at once
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for image_path in annotations:
+            pending.append(pool.submit(export_image, image_path, annotations[image_path], export_dir,
+                                       previous.get(image_path), image_sizes, link_mode, simplify))
+            while pending and (len(pending) >= workers * 4 or pending[0].done()):
+                image_path, entry, wrote, before, after = pending.popleft().result()
+                manifest[image_path] = entry
+                written += wrote
+                vertices_before += before
+                vertices_after += after
+        while pending:
+            image_path, entry, wrote, before, after = pending.popleft().result()
+            manifest[image_path] = entry
+            written += wrote
+            vertices_before += before
+            vertices_after += after
+
+    removed = 0
+    in_use = {(entry['split'], entry['name']) for entry in manifest.values()}
+    for image_path, entry in previous.items():
+        if (entry['split'], entry['name']) not in in_use:
+            remove_exported(export_dir, entry)
+            removed += 1
+    save_manifest(export_dir, manifest)
+
     # Save YAML
     with open(os.path.join(export_dir, 'data.yaml'), 'w') as f:
-        yaml.dump(data_yaml, f, default_flow_style=False)
\ No newline at end of file
+        yaml.dump(data_yaml, f, default_flow_style=False)
+
+    stats = {'images': len(manifest), 'written': written, 'removed': removed,
+             'vertices_before': vertices_before, 'vertices_after': vertices_after}
+    timer.record('export_yolo', time.perf_counter() - start, **stats)
+    return stats
@@ -0,0 +1,144 @@
+# embedding_cache.py (SAM image-embedding cache: in-memory LRU with optional disk spill)
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class ImageEmbedding:
+    """Output of the SAM image encoder plus the sizes the decoder needs to map coordinates."""
+    __slots__ = ("features", "original_size", "input_size")
+
+    def __init__(self, features, original_size, input_size):
+        self.features = features
+        self.original_size = tuple(int(v) for v in original_size)
+        self.input_size = tuple(int(v) for v in input_size)
+
+    @property
+    def nbytes(self):
+        return self.features.nbytes
+
+
+def image_cache_key(image_path):
+    # path + mtime + size: cheap to compute and invalidated when the file is rewritten
+    st = os.stat(image_path)
+    return f"{os.path.abspath(image_path)}:{st.st_mtime_ns}:{st.st_size}"
+
+
+def array_cache_key(image_array):
+    digest = hashlib.sha1(np.ascontiguousarray(image_array).data).hexdigest()
+    return f"array:{image_array.shape}:{digest}"
+
+
+class EmbeddingCache:
+    def __init__(self, max_entries=8, max_bytes=None, disk_dir=None, store=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        # Read-only EmbeddingStore from precompute_embeddings.py, consulted before
+        # computing once use_model() has confirmed it matches the loaded model
+        self.store = store
+        self.model = None
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._entries:
+                return True
+        if self.model is not None and self.store is not None and key in self.store:
+            return True
+        path = self._disk_path(key)
+        return path is not None and os.path.exists(path)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+    def get(self, key):
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+                return embedding
+        if self.model is not None and self.store is not None:
+            # Store hits are memmap views, so they are not counted against the LRU budget
+            embedding = self.store.get(key)
+            if embedding is not None:
+                return embedding
+        embedding = self._load_from_disk(key)
+        if embedding is not None:
+            self.put(key, embedding)
+        return embedding
+
+    def use_model(self, model):
+        # Called once the model is loaded; returns False and drops the store if
+        # its embeddings came from a different model
+        self.model = model
+        if self.store is not None and not self.store.matches(model):
+            self.store = None
+            return False
+        return True
+
+    def put(self, key, embedding):
+        evicted = []
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            self._entries[key] = embedding
+            self._bytes += embedding.nbytes
+            while len(self._entries) > 1 and self._over_budget():
+                evicted.append(self._entries.popitem(last=False))
+                self._bytes -= evicted[-1][1].nbytes
+        for old_key, old_embedding in evicted:
+            self._spill_to_disk(old_key, old_embedding)
+
+    def discard(self, key):
+        with self._lock:
+            embedding = self._entries.pop(key, None)
+            if embedding is not None:
+                self._bytes -= embedding.nbytes
+        return embedding
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _over_budget(self):
+        if self.max_entries is not None and len(self._entries) > self.max_entries:
+            return True
+        return self.max_bytes is not None and self._bytes > self.max_bytes
+
+    def _disk_path(self, key):
+        if not self.disk_dir:
+            return None
+        return os.path.join(self.disk_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".npz")
+
+    def _spill_to_disk(self, key, embedding):
+        path = self._disk_path(key)
+        if path is None or os.path.exists(path):
+            return
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, features=embedding.features,
+                 original_size=np.array(embedding.original_size),
+                 input_size=np.array(embedding.input_size))
+        os.replace(tmp_path, path)
+
+    def _load_from_disk(self, key):
+        path = self._disk_path(key)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                return ImageEmbedding(data["features"], data["original_size"], data["input_size"])
+        except (OSError, ValueError, KeyError):
+            return None
@@ -0,0 +1,149 @@
+# embedding_store.py (memory-mapped store of precomputed SAM image embeddings)
+import os
+import json
+import threading
+import numpy as np
+from embedding_cache import ImageEmbedding
+
+DATA_FILE = "embeddings.dat"
+INDEX_FILE = "index.jsonl"
+META_FILE = "meta.json"
+
+
+class EmbeddingStore:
+    """One flat float32 file holding every embedding plus an append-only index.
+
+    Rows are flushed before their index line is appended, so an interrupted run
+    leaves at most an unindexed row behind and can simply be resumed. The model
+    that produced the embeddings (sam_integration.model_config) is recorded in
+    the meta file; a writable store refuses to mix in another model's output.
+    """
+
+    def __init__(self, directory, writable=False, model=None):
+        self.directory = directory
+        self.writable = writable
+        self.model = model
+        self.feature_shape = None
+        self.dtype = np.dtype(np.float32)
+        self._entries = {}
+        self._data = None
+        self._capacity = 0
+        self._lock = threading.Lock()
+        if writable:
+            os.makedirs(directory, exist_ok=True)
+        meta_path = os.path.join(directory, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            self.feature_shape = tuple(meta["feature_shape"])
+            self.dtype = np.dtype(meta["dtype"])
+            # None for stores written before the model was recorded
+            self.model = meta.get("model")
+            if writable and not self.matches(model):
+                raise ValueError(f"Embedding store {directory} holds embeddings from "
+                                 f"{self.model or 'an unrecorded model'}, not {model}")
+            self._load_index()
+            self._map()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def keys(self):
+        return self._entries.keys()
+
+    def matches(self, model):
+        # Encoders of different SAM variants produce embeddings of the same shape,
+        # so a store is only usable with the exact model that wrote it
+        return self.model is not None and self.model == model
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        with self._lock:
+            # The data file may have been created or grown by a writer after we mapped it
+            if self._data is None or entry["slot"] >= self._capacity:
+                self._map()
+            if self._data is None or entry["slot"] >= self._capacity:
+                return None
+        # A view into the memmap: no copy is made until the features reach the model
+        return ImageEmbedding(self._data[entry["slot"]], entry["original_size"], entry["input_size"])
+
+    def add(self, key, embedding):
+        if not self.writable:
+            raise ValueError("Embedding store was opened read-only")
+        if self.model is None:
+            raise ValueError("Embedding store needs the model that computed its embeddings")
+        with self._lock:
+            if key in self._entries:
+                return
+            if self.feature_shape is None:
+                self._init_meta(embedding.features)
+            elif tuple(embedding.features.shape) != self.feature_shape:
+                raise ValueError(f"Embedding shape {embedding.features.shape} does not match "
+                                 f"store shape {self.feature_shape}")
+            slot = len(self._entries)
+            if slot >= self._capacity:
+                self.reserve(max(16, self._capacity * 2))
+            self._data[slot] = embedding.features
+            self._data.flush()
+            entry = {"key": key, "slot": slot,
+                     "original_size": list(embedding.original_size),
+                     "input_size": list(embedding.input_size)}
+            with open(os.path.join(self.directory, INDEX_FILE), "a") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._entries[key] = entry
+
+    def reserve(self, capacity):
+        if capacity <= self._capacity:
+            return
+        # Growing the file leaves it sparse; rows are only backed once written
+        with open(os.path.join(self.directory, DATA_FILE), "ab") as f:
+            f.truncate(capacity * self._row_bytes())
+        self._map()
+
+    def _init_meta(self, features):
+        self.feature_shape = tuple(features.shape)
+        self.dtype = np.dtype(features.dtype)
+        with open(os.path.join(self.directory, META_FILE), "w") as f:
+            json.dump({"feature_shape": list(self.feature_shape), "dtype": self.dtype.str,
+                       "model": self.model}, f)
+
+    def _row_bytes(self):
+        return int(np.prod(self.feature_shape)) * self.dtype.itemsize
+
+    def _map(self):
+        data_path = os.path.join(self.directory, DATA_FILE)
+        if not os.path.exists(data_path):
+            return
+        self._capacity = os.path.getsize(data_path) // self._row_bytes()
+        if self._capacity == 0:
+            self._data = None
+            return
+        self._data = np.memmap(data_path, dtype=self.dtype, mode="r+" if self.writable else "r",
+                               shape=(self._capacity,) + self.feature_shape)
+
+    def _load_index(self):
+        index_path = os.path.join(self.directory, INDEX_FILE)
+        if not os.path.exists(index_path):
+            return
+        valid_bytes = 0
+        with open(index_path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                self._entries[entry["key"]] = entry
+                valid_bytes += len(line)
+        if self.writable and valid_bytes < os.path.getsize(index_path):
+            # Drop the torn line an interrupted run left behind before appending to it
+            with open(index_path, "r+b") as f:
+                f.truncate(valid_bytes)
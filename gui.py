@@ -1,20 +1,53 @@
 # gui.py (complete with dynamic classes, undo/redo, and enhanced features)
+import os
+from concurrent.futures import ThreadPoolExecutor
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 from PIL import Image, ImageTk, ImageDraw
 import numpy as np
-import copy
-from sam_integration import load_sam_model, generate_masks
-from annotation_processing import create_mask_annotation
-from dataset_export import export_yolo_dataset
+from sam_integration import load_sam_model_async
+from remote_predictor import connect_remote_predictor_async
+from embedding_cache import EmbeddingCache, image_cache_key
+from embedding_store import EmbeddingStore
+from prefetch import EmbeddingPrefetcher, load_image_array
+from inference_worker import InferenceWorker
+from history import (History, AddAnnotation, RemoveAnnotation, RelabelAnnotation, AddClass, EditClass,
+                     CommandGroup)
+from annotation_processing import SIMPLIFY_TOLERANCE, SIMPLIFY_MAX_VERTICES, MIN_FRAGMENT_AREA
+from dataset_export import export_yolo_dataset, read_image_size
+from coco_export import export_coco_dataset
+from image_cache import ImageCache
+from tiled_inference import TiledImage, TiledPyramid, needs_tiling
+from spatial_index import SpatialIndex
+from thumbnails import ThumbnailCache, THUMBNAIL_SIZE
+from propagation import Propagator
+from project_store import ProjectStore, CLASS_COLORS
+from timing import stage, timer
+
+PREFETCH_LOOKAHEAD = 2
+EMBEDDING_CACHE_BYTES = 512 * 1024 * 1024
+INFERENCE_POLL_MS = 30
+HISTORY_MAX_DEPTH = 10000
+REFINE_DELAY_MS = 150
+# Applied to every SAM mask before it is shown; exports write the kept shapes unchanged
+MASK_OPTIONS = {
+    'keep_holes': False,
+    'tolerance': SIMPLIFY_TOLERANCE,
+    'max_vertices': SIMPLIFY_MAX_VERTICES,
+    'min_area': MIN_FRAGMENT_AREA,
+}
+# Annotations this far (display pixels) outside the viewport still get canvas items
+CULL_MARGIN = 200
+# IoU against an existing annotation at which a new mask is flagged
+OVERLAP_WARN_IOU = 0.5
+DUPLICATE_IOU = 0.9
+# Edits on a frame are propagated to the next one after this much quiet time
+PROPAGATE_DELAY_MS = 500
 
 class ClassManager:
     def __init__(self):
         self.classes = {0: {"name": "Class 0", "color": "#FF0000"}}
-        self.colors = [
-            '#FF0000', '#00FF00', '#0000FF', '#FFFF00', '#FF00FF',
-            '#00FFFF', '#800000', '#008000', '#000080', '#808000'
-        ]
+        self.colors = list(CLASS_COLORS)
         
     def add_class(self, class_id, class_name):
         if class_id in self.classes:
@@ -45,26 +78,197 @@ class ClassManager:
     def get_available_classes(self):
         return sorted(self.classes.keys())
 
+class ThumbnailStrip(ttk.Frame):
+    """Scrollable list of all images. Canvas items exist only for the rows on screen,
+    so the cost of a redraw does not grow with the number of images."""
+    ROW_HEIGHT = THUMBNAIL_SIZE + 24
+    WIDTH = THUMBNAIL_SIZE + 16
+
+    def __init__(self, master, app, cache):
+        super().__init__(master)
+        self.app = app
+        self.cache = cache
+        self.rows = {}
+        self.canvas = tk.Canvas(self, width=self.WIDTH, bg='#303030', highlightthickness=0,
+                                yscrollincrement=self.ROW_HEIGHT)
+        scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self.on_scroll)
+        self.canvas.configure(yscrollcommand=scrollbar.set)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.canvas.pack(side=tk.LEFT, fill=tk.Y, expand=True)
+        self.canvas.bind("<Configure>", lambda event: self.render())
+        self.canvas.bind("<MouseWheel>", self.on_wheel)
+        self.canvas.bind("<Button-1>", self.on_click)
+
+    def reset(self):
+        # The image list was replaced
+        self.canvas.delete('all')
+        self.rows = {}
+        self.canvas.configure(scrollregion=(0, 0, self.WIDTH, len(self.app.images) * self.ROW_HEIGHT))
+        self.render()
+
+    def visible_range(self):
+        top = self.canvas.canvasy(0)
+        bottom = self.canvas.canvasy(self.canvas.winfo_height())
+        return (max(0, int(top // self.ROW_HEIGHT)),
+                min(len(self.app.images), int(bottom // self.ROW_HEIGHT) + 1))
+
+    def render(self):
+        first, last = self.visible_range()
+        for index in [index for index in self.rows if not first <= index < last]:
+            self.drop_row(index)
+        self.cache.set_wanted(self.app.images[first:last])
+        for index in range(first, last):
+            if index not in self.rows:
+                self.draw_row(index)
+
+    def refresh(self):
+        # Thumbnails arrived or the current/annotated state changed: redraw the visible rows
+        for index in list(self.rows):
+            self.drop_row(index)
+        self.render()
+
+    def draw_row(self, index):
+        image_path = self.app.images[index]
+        y = index * self.ROW_HEIGHT
+        thumbnail = self.cache.get(image_path)
+        photo = ImageTk.PhotoImage(thumbnail) if thumbnail is not None else None
+        current = index == self.app.current_image_index
+        items = [self.canvas.create_rectangle(2, y + 2, self.WIDTH - 2, y + self.ROW_HEIGHT - 2,
+                                              outline='#4A90D9' if current else '', width=2)]
+        if photo is not None:
+            items.append(self.canvas.create_image(self.WIDTH // 2, y + 4 + THUMBNAIL_SIZE // 2, image=photo))
+        else:
+            items.append(self.canvas.create_rectangle(8, y + 4, self.WIDTH - 8, y + 4 + THUMBNAIL_SIZE,
+                                                      fill='#505050', outline=''))
+        name = os.path.basename(image_path)
+        if len(name) > 16:
+            name = name[:7] + '…' + name[-8:]
+        items.append(self.canvas.create_text(self.WIDTH // 2, y + self.ROW_HEIGHT - 11, text=name,
+                                             fill='white', font=('TkDefaultFont', 8)))
+        if image_path in self.app.annotated:
+            items.append(self.canvas.create_oval(self.WIDTH - 18, y + 6, self.WIDTH - 8, y + 16,
+                                                 fill='#2ECC40', outline=''))
+        self.rows[index] = (items, photo)
+
+    def drop_row(self, index):
+        for item in self.rows.pop(index)[0]:
+            self.canvas.delete(item)
+
+    def scroll_to(self, index):
+        first, last = self.visible_range()
+        if not first <= index < last - 1 and self.app.images:
+            self.canvas.yview_moveto(index / len(self.app.images))
+        self.refresh()
+
+    def on_scroll(self, *args):
+        self.canvas.yview(*args)
+        self.render()
+
+    def on_wheel(self, event):
+        self.canvas.yview_scroll(-1 if event.delta > 0 else 1, 'units')
+        self.render()
+
+    def on_click(self, event):
+        index = int(self.canvas.canvasy(event.y) // self.ROW_HEIGHT)
+        if 0 <= index < len(self.app.images):
+            self.app.goto_image(index)
+
 class MainApplication(tk.Frame):
-    def __init__(self, master=None):
+    def __init__(self, master=None, embedding_store=None, project=None, model_options=None, server=None,
+                 show_timings=False):
         super().__init__(master)
         self.master = master
         self.pack(fill=tk.BOTH, expand=True)
         self.current_image_index = 0
         self.images = []
         self.annotations = {}
+        # Images with at least one annotation, kept up to date per edit so the
+        # status bar and thumbnail strip never rescan the image list
+        self.annotated = set()
+        self.image_sizes = {}
         self.temp_mask = None
+        self.confirm_popup = None
+        # Append the latest per-stage timings to the status bar
+        self.show_timings = show_timings
+        # Objects waiting for a batched decode: [{'points', 'labels', 'box'}, ...]
+        self.prompt_queue = []
+        self.box_start = None
         self.scale_factor = (1, 1)
         self.zoom_level = 1.0
-        self.pan_start = None
+        self.pyramid = None
+        self.original_image = None
+        self.refine_job = None
+        self.annotation_items = {}
+        self.spatial_index = SpatialIndex()
+        self.selected = None
+        self.image_cache = ImageCache(max_images=4)
+        self.tiled_image = None
+        # Large images are decoded into their pixel cache off the Tk thread;
+        # a placeholder is shown until pyramid_future completes
+        self.decode_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tile-decode")
+        self.pyramid_future = None
         self.class_manager = ClassManager()
-        self.annotation_history = []
-        self.history_pointer = -1
+        self.project_store = ProjectStore(project) if project else None
+        self.loaded_images = set()
+        self.history = History(max_depth=HISTORY_MAX_DEPTH, store=self.project_store)
+        if self.project_store is not None:
+            self.open_project()
+        self.embedding_cache = EmbeddingCache(
+            max_entries=None, max_bytes=EMBEDDING_CACHE_BYTES,
+            store=EmbeddingStore(embedding_store) if embedding_store else None)
         
         self.create_widgets()
         self.setup_bindings()
-        self.sam_model = load_sam_model()
-        self.save_state()
+        # The window is usable while the checkpoint loads; clicks wait for it.
+        # With a server, the model (and its embedding cache) lives in that process.
+        if server:
+            self.sam_model = connect_remote_predictor_async(server)
+            self.status.config(text=f"Connecting to inference server {server}...")
+        else:
+            self.sam_model = load_sam_model_async(**(model_options or {}))
+            self.status.config(text="Loading SAM model...")
+        self.model_ready = False
+        self.inference_worker = InferenceWorker(self.sam_model, self.embedding_cache,
+                                                MASK_OPTIONS)
+        self.propagator = Propagator(self.sam_model, self.embedding_cache, MASK_OPTIONS)
+        self.propagate_job = None
+        self.prefetcher = EmbeddingPrefetcher(self.sam_model, self.embedding_cache,
+                                              lookahead=PREFETCH_LOOKAHEAD,
+                                              max_bytes=EMBEDDING_CACHE_BYTES // 2,
+                                              should_wait=self.inference_worker.is_busy)
+        self.after(INFERENCE_POLL_MS, self.poll_inference)
+        self.master.protocol("WM_DELETE_WINDOW", self.on_close)
+        if self.images:
+            self.thumbnail_strip.reset()
+            self.after_idle(self.goto_image, 0)
+
+    def open_project(self):
+        # Only the image list, sizes and classes are read up front; polygons are
+        # loaded per image by load_image_annotations()
+        classes = self.project_store.load_classes()
+        if classes:
+            self.class_manager.classes = classes
+        else:
+            for class_id, info in self.class_manager.classes.items():
+                self.project_store.save_class(class_id, info)
+        self.images = self.project_store.image_paths()
+        self.image_sizes = self.project_store.image_sizes()
+        self.annotated = set(self.project_store.annotated_paths())
+
+    def load_image_annotations(self, image_path):
+        if self.project_store is None or image_path in self.loaded_images:
+            return
+        anns = self.project_store.load_annotations(image_path)
+        if anns:
+            self.annotations[image_path] = anns
+        self.loaded_images.add(image_path)
+
+    def on_close(self):
+        self.thumbnail_cache.shutdown()
+        self.decode_pool.shutdown(wait=False, cancel_futures=True)
+        if self.project_store is not None:
+            self.project_store.close()
+        self.master.destroy()
 
     def create_widgets(self):
         # Control Panel
@@ -76,7 +280,14 @@ class MainApplication(tk.Frame):
         ttk.Button(control_frame, text="📁", command=self.upload_images).pack(side=tk.LEFT, padx=2)
         ttk.Button(control_frame, text="Prev", command=self.prev_image).pack(side=tk.LEFT, padx=2)
         ttk.Button(control_frame, text="Next", command=self.next_image).pack(side=tk.LEFT, padx=2)
+        self.queue_mode = tk.BooleanVar(value=False)
+        ttk.Checkbutton(control_frame, text="Queue", variable=self.queue_mode,
+                        command=self.clear_prompt_queue).pack(side=tk.LEFT, padx=2)
+        self.propagate_mode = tk.BooleanVar(value=False)
+        ttk.Checkbutton(control_frame, text="Propagate", variable=self.propagate_mode,
+                        command=self.on_propagate_toggled).pack(side=tk.LEFT, padx=2)
         ttk.Button(control_frame, text="Export", command=self.export_dataset).pack(side=tk.RIGHT, padx=2)
+        ttk.Button(control_frame, text="Export COCO", command=self.export_coco).pack(side=tk.RIGHT, padx=2)
         
         # Class Panel
         class_frame = ttk.Frame(self.master, width=200)
@@ -87,6 +298,11 @@ class MainApplication(tk.Frame):
         self.class_canvas.pack()
         ttk.Button(class_frame, text="Manage Classes", command=self.show_class_manager).pack(pady=5)
         
+        # Image Browser
+        self.thumbnail_cache = ThumbnailCache()
+        self.thumbnail_strip = ThumbnailStrip(self.master, self, self.thumbnail_cache)
+        self.thumbnail_strip.pack(side=tk.LEFT, fill=tk.Y, padx=(5, 0), pady=5)
+        
         # Main Canvas
         self.canvas = tk.Canvas(self.master, bg='gray', width=1280, height=1280)
         self.canvas.pack(fill=tk.BOTH, expand=True)
@@ -156,61 +372,132 @@ class MainApplication(tk.Frame):
                 raise ValueError("Class name cannot be empty")
                 
             if old_id is None:
-                self.class_manager.add_class(new_id, new_name)
+                self.run_command(AddClass(new_id, new_name))
             else:
-                self.class_manager.edit_class(old_id, new_id, new_name)
-                self.update_annotations_class(old_id, new_id)
+                self.run_command(EditClass(old_id, new_id, new_name))
             
-            self.save_state()
-            self.update_class_display()
+            self.refresh_after_edit()
             dialog.destroy()
         except Exception as e:
             messagebox.showerror("Error", str(e))
 
-    def update_annotations_class(self, old_id, new_id):
-        for img_path in self.annotations:
-            for ann in self.annotations[img_path]:
-                if ann['class_id'] == old_id:
-                    ann['class_id'] = new_id
-
-    def save_state(self):
-        state = {
-            "annotations": copy.deepcopy(self.annotations),
-            "classes": copy.deepcopy(self.class_manager.classes)
-        }
-        self.annotation_history = self.annotation_history[:self.history_pointer+1]
-        self.annotation_history.append(state)
-        self.history_pointer = len(self.annotation_history) - 1
+    def run_command(self, command):
+        self.history.execute(command, self)
+        self.on_annotations_changed(command)
 
     def undo(self):
-        if self.history_pointer > 0:
-            self.history_pointer -= 1
-            self.restore_state()
+        command = self.history.undo(self)
+        if command:
+            self.on_annotations_changed(command)
+            self.refresh_after_edit()
 
     def redo(self):
-        if self.history_pointer < len(self.annotation_history)-1:
-            self.history_pointer += 1
-            self.restore_state()
-
-    def restore_state(self):
-        state = self.annotation_history[self.history_pointer]
-        self.annotations = copy.deepcopy(state["annotations"])
-        self.class_manager.classes = copy.deepcopy(state["classes"])
+        command = self.history.redo(self)
+        if command:
+            self.on_annotations_changed(command)
+            self.refresh_after_edit()
+
+    def on_annotations_changed(self, command):
+        # Only the images the command touched can change annotated state
+        paths = {c.image_path for c in getattr(command, 'commands', [command]) if c.image_path}
+        changed = False
+        for image_path in paths:
+            was_annotated = image_path in self.annotated
+            if self.annotations.get(image_path):
+                self.annotated.add(image_path)
+            else:
+                self.annotated.discard(image_path)
+            changed |= was_annotated != (image_path in self.annotated)
+        if changed:
+            self.thumbnail_strip.refresh()
+        if self.propagate_mode.get() and self.images and self.images[self.current_image_index] in paths:
+            self.schedule_propagation()
+
+    def on_propagate_toggled(self):
+        if self.propagate_mode.get() and self.images:
+            self.schedule_propagation()
+            self.offer_propagation()
+
+    def schedule_propagation(self):
+        if self.propagate_job is not None:
+            self.after_cancel(self.propagate_job)
+        self.propagate_job = self.after(PROPAGATE_DELAY_MS, self.propagate_ahead)
+
+    def propagate_ahead(self):
+        # The next frame is decoded in the background while the current one is worked on
+        self.propagate_job = None
+        index = self.current_image_index
+        if not self.propagate_mode.get() or index + 1 >= len(self.images):
+            return
+        self.propagate_frame(self.images[index], self.images[index + 1])
+
+    def propagate_frame(self, source_path, target_path):
+        if target_path in self.annotated:
+            return
+        self.load_image_annotations(source_path)
+        annotations = self.annotations.get(source_path)
+        if annotations:
+            self.propagator.propose(list(annotations), target_path,
+                                    lambda: load_image_array(target_path))
+        else:
+            self.propagator.discard(target_path)
+
+    def offer_propagation(self):
+        # Present the objects carried over from the previous frame for bulk accept
+        index = self.current_image_index
+        image_path = self.images[index]
+        if image_path in self.annotated or self.confirm_popup is not None:
+            return
+        annotations = self.propagator.take(image_path)
+        if annotations is None:
+            if index > 0 and not self.propagator.is_pending(image_path):
+                self.propagate_frame(self.images[index - 1], image_path)
+            return
+        if not annotations:
+            return
+        self.temp_mask = {'annotations': annotations, 'propagated': True}
+        self.show_mask_preview()
+        self.show_confirmation_dialog()
+        self.status.config(text=f"{len(annotations)} objects propagated from the previous frame")
+
+    def refresh_after_edit(self):
         self.update_class_display()
-        self.show_image()
+        self.draw_existing_annotations()
+        if self.images:
+            self.update_status()
 
     def setup_bindings(self):
         self.canvas.bind("<Button-1>", self.on_image_click)
+        self.canvas.bind("<Shift-Button-1>", lambda event: self.on_image_click(event, label=0))
+        self.canvas.bind("<ButtonPress-3>", self.start_box)
+        self.canvas.bind("<B3-Motion>", self.drag_box)
+        self.canvas.bind("<ButtonRelease-3>", self.end_box)
+        self.master.bind("<Return>", lambda event: self.decode_prompt_queue())
+        self.master.bind("<Key-n>", lambda event: self.new_queued_object())
+        self.master.bind("<Escape>", lambda event: self.on_escape())
+        self.canvas.bind("<Control-Button-1>", self.select_annotation)
+        self.master.bind("<Delete>", lambda event: self.delete_selected())
+        self.master.bind("<BackSpace>", lambda event: self.delete_selected())
+        for digit in range(10):
+            self.master.bind(f"<Key-{digit}>", lambda event, d=digit: self.relabel_selected(d))
         self.canvas.bind("<MouseWheel>", self.zoom)
         self.canvas.bind("<ButtonPress-2>", self.start_pan)
         self.canvas.bind("<B2-Motion>", self.pan)
+        self.canvas.bind("<Configure>", lambda event: self.schedule_refine())
 
     def upload_images(self):
         files = filedialog.askopenfilenames(filetypes=[("Images", "*.jpg *.jpeg *.png")])
         if files:
-            self.images = list(files)
-            self.current_image_index = 0
-            self.show_image()
+            if self.project_store is not None:
+                self.project_store.add_images(files)
+                self.images = self.project_store.image_paths()
+                self.thumbnail_strip.reset()
+                self.goto_image(self.images.index(files[0]))
+            else:
+                self.images = list(files)
+                self.annotated = {path for path in self.images if self.annotations.get(path)}
+                self.thumbnail_strip.reset()
+                self.goto_image(0)
 
     def show_image(self):
         self.clear_canvas()
@@ -218,123 +505,448 @@ class MainApplication(tk.Frame):
             return
             
         image_path = self.images[self.current_image_index]
-        pil_image = Image.open(image_path).convert('RGB')
-        self.original_image = pil_image.copy()
-        
-        # Apply zoom
-        w, h = pil_image.size
-        new_size = (int(w * self.zoom_level), int(h * self.zoom_level))
-        pil_image = pil_image.resize(new_size, Image.LANCZOS)
-        
-        self.scale_factor = (
-            self.original_image.width / pil_image.width,
-            self.original_image.height / pil_image.height
-        )
-        
-        self.tk_image = ImageTk.PhotoImage(pil_image)
-        self.canvas.config(width=pil_image.width, height=pil_image.height)
-        self.canvas.create_image(0, 0, anchor=tk.NW, image=self.tk_image)
+        if needs_tiling(read_image_size(image_path)):
+            # Never decoded into memory whole: displayed and segmented through
+            # the memory-mapped pixel cache
+            if self.tiled_image is None or self.tiled_image.image_path != image_path:
+                self.tiled_image = TiledImage(image_path)
+                self.pyramid = TiledPyramid(self.tiled_image)
+                self.pyramid_future = self.decode_pool.submit(self.pyramid.load)
+            self.original_image = None
+        else:
+            self.tiled_image = None
+            self.pyramid_future = None
+            self.pyramid = self.image_cache.get(image_path)
+            self.original_image = self.pyramid.image
+        if self.image_sizes.get(image_path) != self.pyramid.size:
+            self.image_sizes[image_path] = self.pyramid.size
+            if self.project_store is not None:
+                self.project_store.set_image_size(image_path, *self.pyramid.size)
+        self.load_image_annotations(image_path)
+        self.update_zoom()
         self.draw_existing_annotations()
         self.update_status()
 
+    def update_zoom(self, fast=False):
+        w, h = self.pyramid.size
+        display_w = max(1, int(w * self.zoom_level))
+        display_h = max(1, int(h * self.zoom_level))
+        self.scale_factor = (w / display_w, h / display_h)
+        self.canvas.config(scrollregion=(0, 0, display_w, display_h))
+        self.render_view(fast)
+
+    def render_view(self, fast=False):
+        # Only the part of the zoomed image that is on screen gets resampled
+        if self.pyramid is None:
+            return
+        viewport = (self.canvas.canvasx(0), self.canvas.canvasy(0),
+                    self.canvas.canvasx(self.canvas.winfo_width()),
+                    self.canvas.canvasy(self.canvas.winfo_height()))
+        image, origin = self.pyramid.render(self.zoom_level, viewport, fast)
+        self.canvas.delete('image')
+        if image is None:
+            if self.pyramid_future is not None:
+                self.canvas.create_text(viewport[0] + 10, viewport[1] + 10, anchor=tk.NW, tags='image',
+                                        text="Decoding large image...")
+            return
+        self.tk_image = ImageTk.PhotoImage(image)
+        self.canvas.create_image(origin[0], origin[1], anchor=tk.NW, image=self.tk_image, tags='image')
+        self.canvas.tag_lower('image')
+
+    def schedule_refine(self):
+        # Interaction uses a fast resampler; redo the view properly once input stops
+        if self.refine_job is not None:
+            self.after_cancel(self.refine_job)
+        self.refine_job = self.after(REFINE_DELAY_MS, self.refine_view)
+
+    def refine_view(self):
+        self.refine_job = None
+        self.render_view()
+        self.draw_existing_annotations()
+        if self.temp_mask is not None:
+            self.show_mask_preview()
+
     def draw_existing_annotations(self):
+        # Canvas items persist across edits and zoom; only annotations that were
+        # added, removed or relabelled since the last call touch the canvas, and
+        # only those near the viewport have items at all.
+        if not self.images:
+            return
+        image_path = self.images[self.current_image_index]
+        self.spatial_index.sync(self.annotations.get(image_path, []))
+        if self.selected is not None and self.selected not in self.spatial_index:
+            self.selected = None
+        sx, sy = self.scale_factor
+        visible = self.spatial_index.query_box(
+            (self.canvas.canvasx(0) - CULL_MARGIN) * sx,
+            (self.canvas.canvasy(0) - CULL_MARGIN) * sy,
+            (self.canvas.canvasx(self.canvas.winfo_width()) + CULL_MARGIN) * sx,
+            (self.canvas.canvasy(self.canvas.winfo_height()) + CULL_MARGIN) * sy)
+        current = {id(ann) for ann in visible}
+        for key in [key for key in self.annotation_items if key not in current]:
+            for item in self.annotation_items.pop(key)[1]:
+                self.canvas.delete(item)
+        for ann in visible:
+            entry = self.annotation_items.get(id(ann))
+            class_info = self.class_manager.get_class_info(ann.class_id)
+            if entry is None:
+                items = [self.canvas.create_polygon(contour.ravel().tolist(), outline=class_info['color'],
+                                                    fill='', width=2, tags='annotation')
+                         for contour in ann.scaled(*self.scale_factor, holes=True)]
+                self.annotation_items[id(ann)] = (ann, items, ann.class_id)
+            elif entry[2] != ann.class_id:
+                for item in entry[1]:
+                    self.canvas.itemconfig(item, outline=class_info['color'])
+                self.annotation_items[id(ann)] = (ann, entry[1], ann.class_id)
+        self.highlight_selection()
+
+    def select_annotation(self, event):
+        if not self.images:
+            return
+        x = self.canvas.canvasx(event.x) * self.scale_factor[0]
+        y = self.canvas.canvasy(event.y) * self.scale_factor[1]
+        hits = self.spatial_index.query_point(x, y)
+        if self.selected in hits:
+            # Clicking the same spot again walks outwards through nested annotations
+            selected = hits[(hits.index(self.selected) + 1) % len(hits)]
+        else:
+            selected = hits[0] if hits else None
+        self.set_selection(selected)
+
+    def set_selection(self, annotation):
+        previous, self.selected = self.selected, annotation
+        if previous is not None and id(previous) in self.annotation_items:
+            for item in self.annotation_items[id(previous)][1]:
+                self.canvas.itemconfig(item, width=2)
+        self.highlight_selection()
+        if annotation is None:
+            self.update_status()
+        else:
+            class_info = self.class_manager.get_class_info(annotation.class_id)
+            self.status.config(text=f"Selected: {class_info['name']} | Delete: remove, 0-9: relabel, Esc: deselect")
+
+    def highlight_selection(self):
+        if self.selected is not None and id(self.selected) in self.annotation_items:
+            for item in self.annotation_items[id(self.selected)][1]:
+                self.canvas.itemconfig(item, width=4)
+
+    def selected_index(self):
         image_path = self.images[self.current_image_index]
-        if image_path in self.annotations:
-            for ann in self.annotations[image_path]:
-                class_info = self.class_manager.get_class_info(ann['class_id'])
-                scaled_poly = [(x/self.scale_factor[0], y/self.scale_factor[1]) 
-                             for x, y in ann['polygon']]
-                self.canvas.create_polygon(scaled_poly, outline=class_info['color'], 
-                                         fill='', width=2)
-
-    def on_image_click(self, event):
+        for index, ann in enumerate(self.annotations.get(image_path, [])):
+            if ann is self.selected:
+                return image_path, index
+        return image_path, None
+
+    def delete_selected(self):
+        if self.selected is None:
+            return
+        image_path, index = self.selected_index()
+        if index is not None:
+            self.run_command(RemoveAnnotation(image_path, index))
+        self.set_selection(None)
+        self.draw_existing_annotations()
+
+    def relabel_selected(self, class_id):
+        if self.selected is None:
+            return
+        if class_id not in self.class_manager.classes:
+            self.status.config(text=f"No class with ID {class_id}")
+            return
+        image_path, index = self.selected_index()
+        if index is not None and self.selected.class_id != class_id:
+            self.run_command(RelabelAnnotation(image_path, index, class_id))
+            self.draw_existing_annotations()
+        self.set_selection(self.selected)
+
+    def on_escape(self):
+        if self.selected is not None:
+            self.set_selection(None)
+        else:
+            self.clear_prompt_queue()
+
+    def overlap_warning(self, annotations):
+        # New masks are checked against the annotations already on the image
+        best = 0.0
+        for ann in annotations:
+            overlaps = self.spatial_index.overlaps(ann, OVERLAP_WARN_IOU)
+            if overlaps:
+                best = max(best, overlaps[0][1])
+        if best >= DUPLICATE_IOU:
+            return f"Possible duplicate of an existing annotation (IoU {best:.2f})"
+        if best:
+            return f"Overlaps an existing annotation (IoU {best:.2f})"
+        return None
+
+    def on_image_click(self, event, label=1):
+        # label 0 (shift-click) is a negative point; it only means something
+        # as part of a queued object
         if not self.images:
             return
             
-        original_x = event.x * self.scale_factor[0]
-        original_y = event.y * self.scale_factor[1]
+        canvas_x = self.canvas.canvasx(event.x)
+        canvas_y = self.canvas.canvasy(event.y)
+        original_x = canvas_x * self.scale_factor[0]
+        original_y = canvas_y * self.scale_factor[1]
         
-        self.canvas.create_oval(event.x-3, event.y-3, event.x+3, event.y+3,
-                              fill='blue', tags='click_marker')
-        self.generate_and_show_mask(original_x, original_y)
+        self.canvas.create_oval(canvas_x-3, canvas_y-3, canvas_x+3, canvas_y+3,
+                              fill='blue' if label else 'red', tags='click_marker')
+        if self.queue_mode.get():
+            self.queue_prompt(point=(original_x, original_y), label=label)
+        else:
+            self.generate_and_show_mask(original_x, original_y)
+
+    def start_box(self, event):
+        if not self.images:
+            return
+        self.box_start = (self.canvas.canvasx(event.x), self.canvas.canvasy(event.y))
+        self.canvas.create_rectangle(*self.box_start, *self.box_start, outline='blue', dash=(4, 2),
+                                     tags='box_drag')
+
+    def drag_box(self, event):
+        if self.box_start is not None:
+            self.canvas.coords('box_drag', *self.box_start,
+                               self.canvas.canvasx(event.x), self.canvas.canvasy(event.y))
+
+    def end_box(self, event):
+        if self.box_start is None:
+            return
+        x0, y0 = self.box_start
+        x1, y1 = self.canvas.canvasx(event.x), self.canvas.canvasy(event.y)
+        self.box_start = None
+        self.canvas.delete('box_drag')
+        if abs(x1 - x0) < 3 or abs(y1 - y0) < 3:
+            return
+        x0, x1 = sorted((x0, x1))
+        y0, y1 = sorted((y0, y1))
+        self.canvas.create_rectangle(x0, y0, x1, y1, outline='blue', tags='click_marker')
+        sx, sy = self.scale_factor
+        box = (x0 * sx, y0 * sy, x1 * sx, y1 * sy)
+        if self.queue_mode.get():
+            self.queue_prompt(box=box)
+        else:
+            self.submit_prompts([{'points': None, 'labels': None, 'box': np.array(box)}])
+
+    def queue_prompt(self, point=None, label=1, box=None):
+        # Points go to the current object; a second box starts a new one
+        if not self.prompt_queue or (box is not None and self.prompt_queue[-1]['box'] is not None):
+            self.prompt_queue.append({'points': [], 'labels': [], 'box': None})
+        current = self.prompt_queue[-1]
+        if point is not None:
+            current['points'].append(point)
+            current['labels'].append(label)
+        if box is not None:
+            current['box'] = box
+        self.show_queue_status()
+
+    def new_queued_object(self):
+        if self.queue_mode.get() and self.prompt_queue and (
+                self.prompt_queue[-1]['points'] or self.prompt_queue[-1]['box'] is not None):
+            self.prompt_queue.append({'points': [], 'labels': [], 'box': None})
+            self.show_queue_status()
+
+    def show_queue_status(self):
+        objects = sum(1 for p in self.prompt_queue if p['points'] or p['box'] is not None)
+        self.status.config(text=f"Queued objects: {objects} | n: next object, Enter: decode, Esc: clear")
+
+    def clear_prompt_queue(self):
+        self.prompt_queue = []
+        self.canvas.delete('click_marker')
+        if self.images:
+            self.update_status()
+
+    def decode_prompt_queue(self):
+        # Objects without a positive point or a box cannot be decoded on their own
+        prompts = [{'points': np.array(p['points']) if p['points'] else None,
+                    'labels': np.array(p['labels']) if p['labels'] else None,
+                    'box': np.array(p['box']) if p['box'] is not None else None}
+                   for p in self.prompt_queue if 1 in p['labels'] or p['box'] is not None]
+        self.prompt_queue = []
+        if prompts:
+            self.submit_prompts(prompts)
 
     def generate_and_show_mask(self, x, y):
         image_path = self.images[self.current_image_index]
-        image_array = np.array(self.original_image)
-        
-        masks = generate_masks(self.sam_model, image_array, np.array([[x, y]]))
-        
-        if masks is not None and len(masks) > 0:
-            mask = masks[0]
-            polygon = create_mask_annotation(mask)
-            self.temp_mask = {
-                'polygon': polygon,
-                'preview_image': self.create_mask_preview(polygon)
-            }
+        image = self.original_image
+        self.inference_worker.submit(image_cache_key(image_path), image_path,
+                                     lambda: np.array(image), np.array([[x, y]]),
+                                     np.array([1]), self.show_mask_result, self.tiled_image)
+        self.status.config(text="Computing mask...")
+
+    def submit_prompts(self, prompts):
+        # All objects are decoded against the image embedding in one batched call
+        image_path = self.images[self.current_image_index]
+        image = self.original_image
+        self.inference_worker.submit(image_cache_key(image_path), image_path,
+                                     lambda: np.array(image), None, None, self.show_mask_result,
+                                     self.tiled_image, prompts)
+        self.status.config(text=f"Computing {len(prompts)} masks...")
+
+    def poll_inference(self):
+        # Results are produced on the worker thread and handed to Tk here
+        if not self.model_ready and self.sam_model.done():
+            self.model_ready = True
+            if self.sam_model.exception() is not None:
+                messagebox.showerror("Error", f"Failed to load SAM model: {self.sam_model.exception()}")
+            else:
+                self.on_model_loaded(self.sam_model.result())
+        if self.pyramid_future is not None and self.pyramid_future.done():
+            self.on_pyramid_loaded()
+        for result in self.inference_worker.poll():
+            result.request.callback(result)
+        if self.thumbnail_cache.poll():
+            self.thumbnail_strip.refresh()
+        for image_path in self.propagator.poll():
+            if (self.propagate_mode.get() and self.images and self.confirm_popup is None
+                    and image_path == self.images[self.current_image_index]):
+                self.offer_propagation()
+        self.after(INFERENCE_POLL_MS, self.poll_inference)
+
+    def on_pyramid_loaded(self):
+        future, self.pyramid_future = self.pyramid_future, None
+        if future.exception() is not None:
+            messagebox.showerror("Error", f"Failed to decode image: {future.exception()}")
+        else:
+            self.render_view()
+
+    def on_model_loaded(self, predictor):
+        # A remote server checks its own embedding store; the local one is unused then
+        if (not getattr(predictor, "is_remote", False)
+                and not self.embedding_cache.use_model(predictor.model_config)):
+            messagebox.showwarning("Embedding Store", "The embedding store was computed with a "
+                                   "different SAM model and will be ignored.")
+        if self.images:
+            self.update_status()
+        else:
+            self.status.config(text="Ready")
+
+    def show_mask_result(self, result):
+        if not self.images or result.request.image_path != self.images[self.current_image_index]:
+            return
+        annotations = result.annotations
+        if annotations is None:
+            annotations = [result.annotation] if result.annotation else []
+        if result.error is not None:
+            self.show_result_status(result)
+            messagebox.showerror("Error", str(result.error))
+            self.clear_temp_mask()
+        elif annotations:
+            self.close_confirmation_dialog()
+            self.temp_mask = {'annotations': annotations}
+            self.show_mask_preview()
+            # After the preview, so the timing readout includes it
+            self.show_result_status(result)
             self.show_confirmation_dialog()
         else:
+            self.show_result_status(result)
             messagebox.showwarning("No Mask", "No mask found")
             self.clear_temp_mask()
 
-    def create_mask_preview(self, polygon):
+    def show_result_status(self, result):
+        self.update_status()
+        if result.vertices is not None:
+            self.status.config(text=self.status.cget('text') +
+                               f" | Mask vertices: {result.vertices[0]} -> {result.vertices[1]}")
+
+    def create_mask_preview(self, annotation):
+        # Only the mask's bounding box, clipped to the visible area, is rasterized
         class_info = self.class_manager.get_class_info(0)
         rgb = tuple(int(class_info['color'].lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
         
-        overlay = Image.new('RGBA', self.original_image.size, (0,0,0,0))
+        sx, sy = self.scale_factor
+        bx0, by0, bx1, by1 = annotation.bbox
+        x0 = max(int(bx0 / sx), int(self.canvas.canvasx(0)))
+        y0 = max(int(by0 / sy), int(self.canvas.canvasy(0)))
+        x1 = min(int(np.ceil(bx1 / sx)) + 1, int(self.canvas.canvasx(self.canvas.winfo_width())) + 1)
+        y1 = min(int(np.ceil(by1 / sy)) + 1, int(self.canvas.canvasy(self.canvas.winfo_height())) + 1)
+        if x1 <= x0 or y1 <= y0:
+            return None, (0, 0)
+
+        overlay = Image.new('RGBA', (x1 - x0, y1 - y0), (0,0,0,0))
         draw = ImageDraw.Draw(overlay)
-        scaled_poly = [(x/self.scale_factor[0], y/self.scale_factor[1]) 
-                     for x, y in polygon]
-        draw.polygon(scaled_poly, fill=rgb + (50,), outline=rgb + (200,))
-        return ImageTk.PhotoImage(overlay.resize(
-            (int(self.original_image.width),
-             int(self.original_image.height))))
+        for contour in annotation.scaled(sx, sy):
+            draw.polygon((contour - (x0, y0)).ravel().tolist(),
+                         fill=rgb + (50,), outline=rgb + (200,))
+        for hole in annotation.holes:
+            draw.polygon((hole / (sx, sy) - (x0, y0)).ravel().tolist(),
+                         fill=(0, 0, 0, 0), outline=rgb + (200,))
+        return ImageTk.PhotoImage(overlay), (x0, y0)
 
     def show_confirmation_dialog(self):
         popup = tk.Toplevel(self.master)
-        popup.title("Confirm Mask")
-        popup.geometry("300x150")
+        count = len(self.temp_mask['annotations'])
+        popup.title("Confirm Mask" if count == 1 else f"Confirm {count} Masks")
+        warning = self.overlap_warning(self.temp_mask['annotations'])
+        popup.geometry("300x180" if warning else "300x150")
+        if warning:
+            ttk.Label(popup, text=warning, foreground='#B00000', wraplength=280).pack(pady=(10, 0))
         
         class_frame = ttk.Frame(popup)
         class_frame.pack(pady=10)
         
-        ttk.Label(class_frame, text="Class:").pack(side=tk.LEFT)
         self.class_var = tk.IntVar(value=0)
-        class_menu = ttk.Combobox(class_frame, textvariable=self.class_var, 
-                                values=list(self.class_manager.classes.keys()))
-        class_menu.pack(side=tk.LEFT, padx=5)
+        if self.temp_mask.get('propagated'):
+            ttk.Label(class_frame, text="Classes kept from the previous frame").pack(side=tk.LEFT)
+        else:
+            ttk.Label(class_frame, text="Class:").pack(side=tk.LEFT)
+            class_menu = ttk.Combobox(class_frame, textvariable=self.class_var, 
+                                    values=list(self.class_manager.classes.keys()))
+            class_menu.pack(side=tk.LEFT, padx=5)
         
         btn_frame = ttk.Frame(popup)
         btn_frame.pack(pady=10)
         
-        ttk.Button(btn_frame, text="Keep", command=lambda: self.finalize_mask(popup)).pack(side=tk.LEFT, padx=10)
+        ttk.Button(btn_frame, text="Keep" if count == 1 else "Keep All",
+                   command=lambda: self.finalize_mask(popup)).pack(side=tk.LEFT, padx=10)
         ttk.Button(btn_frame, text="Discard", command=lambda: self.discard_mask(popup)).pack(side=tk.RIGHT, padx=10)
-        
-        self.canvas.create_image(0, 0, anchor=tk.NW, image=self.temp_mask['preview_image'], tags='mask_preview')
+        popup.protocol("WM_DELETE_WINDOW", lambda: self.discard_mask(popup))
+        self.confirm_popup = popup
+
+    def show_mask_preview(self):
+        self.canvas.delete('mask_preview')
+        # PhotoImages are kept in temp_mask so Tk does not lose them to garbage collection
+        self.temp_mask['preview_images'] = []
+        with stage('preview_render', masks=len(self.temp_mask['annotations'])):
+            for annotation in self.temp_mask['annotations']:
+                preview, (x0, y0) = self.create_mask_preview(annotation)
+                if preview is not None:
+                    self.temp_mask['preview_images'].append(preview)
+                    self.canvas.create_image(x0, y0, anchor=tk.NW, image=preview, tags='mask_preview')
+
+    def close_confirmation_dialog(self):
+        # A newer mask replaces the one still waiting for Keep/Discard
+        if self.confirm_popup is not None:
+            self.confirm_popup.destroy()
+            self.confirm_popup = None
+        self.canvas.delete('mask_preview')
 
     def finalize_mask(self, popup):
         try:
             class_id = self.class_var.get()
-            if class_id not in self.class_manager.classes:
+            propagated = self.temp_mask.get('propagated')
+            if not propagated and class_id not in self.class_manager.classes:
                 raise ValueError("Invalid class selected")
             
             image_path = self.images[self.current_image_index]
-            if image_path not in self.annotations:
-                self.annotations[image_path] = []
-                
-            self.annotations[image_path].append({
-                'polygon': self.temp_mask['polygon'],
-                'class_id': class_id
-            })
+            commands = []
+            for annotation in self.temp_mask['annotations']:
+                if not propagated:
+                    annotation.class_id = class_id
+                commands.append(AddAnnotation(image_path, annotation))
+            # Accepting a batch is a single undo step
+            self.run_command(commands[0] if len(commands) == 1 else CommandGroup(commands))
             
-            self.save_state()
             popup.destroy()
-            self.show_image()
+            self.confirm_popup = None
+            self.clear_temp_mask()
+            self.draw_existing_annotations()
+            self.update_status()
         except Exception as e:
             messagebox.showerror("Error", str(e))
 
     def discard_mask(self, popup):
         self.clear_temp_mask()
         popup.destroy()
+        self.confirm_popup = None
 
     def clear_temp_mask(self):
         self.temp_mask = None
@@ -344,30 +956,56 @@ class MainApplication(tk.Frame):
     def zoom(self, event):
         self.zoom_level *= 1.1 if event.delta > 0 else 0.9
         self.zoom_level = max(0.1, min(5.0, self.zoom_level))
-        self.show_image()
+        if self.pyramid is None:
+            return
+        old_scale = self.scale_factor[0]
+        self.update_zoom(fast=True)
+        ratio = old_scale / self.scale_factor[0]
+        self.canvas.scale('click_marker', 0, 0, ratio, ratio)
+        self.canvas.scale('annotation', 0, 0, ratio, ratio)
+        if self.temp_mask is not None:
+            self.show_mask_preview()
+        self.schedule_refine()
 
     def start_pan(self, event):
-        self.pan_start = (event.x, event.y)
+        self.canvas.scan_mark(event.x, event.y)
 
     def pan(self, event):
-        if self.pan_start:
-            dx = event.x - self.pan_start[0]
-            dy = event.y - self.pan_start[1]
-            self.canvas.scan_dragto(dx, dy, gain=1)
-            self.pan_start = (event.x, event.y)
+        self.canvas.scan_dragto(event.x, event.y, gain=1)
+        self.render_view(fast=True)
+        self.schedule_refine()
 
     def prev_image(self):
         if self.current_image_index > 0:
-            self.current_image_index -= 1
-            self.show_image()
+            self.goto_image(self.current_image_index - 1)
 
     def next_image(self):
         if self.current_image_index < len(self.images)-1:
-            self.current_image_index += 1
-            self.show_image()
+            self.goto_image(self.current_image_index + 1)
+
+    def goto_image(self, index):
+        self.current_image_index = index
+        self.show_image()
+        self.on_image_changed()
+
+    def on_image_changed(self):
+        self.thumbnail_strip.scroll_to(self.current_image_index)
+        self.inference_worker.cancel()
+        self.prompt_queue = []
+        self.close_confirmation_dialog()
+        self.prefetcher.update(self.images, self.current_image_index)
+        if self.propagate_mode.get():
+            self.offer_propagation()
+            self.schedule_propagation()
+
+    def exportable_annotations(self):
+        # With a project store the in-memory dict only holds visited images
+        if self.project_store is not None:
+            return self.project_store.annotations_view()
+        return self.annotations
 
     def export_dataset(self):
-        if not self.annotations:
+        if not self.exportable_annotations():
             messagebox.showerror("Error", "No annotations to export!")
             return
             
@@ -375,16 +1013,42 @@ class MainApplication(tk.Frame):
         if export_dir:
             try:
                 class_names = {cid: info['name'] for cid, info in self.class_manager.classes.items()}
-                export_yolo_dataset(self.annotations, export_dir, class_names)
-                messagebox.showinfo("Success", f"Dataset exported to {export_dir}")
+                stats = export_yolo_dataset(self.exportable_annotations(), export_dir, class_names,
+                                            image_sizes=self.image_sizes)
+                messagebox.showinfo("Success", f"Dataset exported to {export_dir} "
+                                    f"({stats['written']} of {stats['images']} images updated, "
+                                    f"{stats['vertices_after']} vertices)")
+            except Exception as e:
+                messagebox.showerror("Error", str(e))
+
+    def export_coco(self):
+        if not self.exportable_annotations():
+            messagebox.showerror("Error", "No annotations to export!")
+            return
+
+        output_path = filedialog.asksaveasfilename(defaultextension=".json",
+                                                   filetypes=[("COCO JSON", "*.json")])
+        if output_path:
+            try:
+                class_names = {cid: info['name'] for cid, info in self.class_manager.classes.items()}
+                segmentation = 'rle' if messagebox.askyesno(
+                    "COCO Export", "Store masks as compressed RLE instead of polygons?") else 'polygon'
+                stats = export_coco_dataset(self.exportable_annotations(), output_path, class_names,
+                                            image_sizes=self.image_sizes, segmentation=segmentation)
+                messagebox.showinfo("Success", f"{stats['annotations']} annotations exported to {output_path} "
+                                    f"({stats['vertices_after']} vertices)")
             except Exception as e:
                 messagebox.showerror("Error", str(e))
 
     def update_status(self):
         total = len(self.images)
-        annotated = len([img for img in self.images if img in self.annotations])
-        self.status.config(text=f"Image {self.current_image_index+1}/{total} | Annotated: {annotated}/{total}")
+        text = f"Image {self.current_image_index+1}/{total} | Annotated: {len(self.annotated)}/{total}"
+        readout = timer.readout() if self.show_timings else ""
+        self.status.config(text=f"{text} | {readout}" if readout else text)
 
     def clear_canvas(self):
         self.canvas.delete("all")
+        self.annotation_items = {}
+        self.spatial_index = SpatialIndex()
+        self.selected = None
         self.temp_mask = None
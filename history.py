@@ -0,0 +1,218 @@
+# history.py (command-based undo/redo: each step stores only what it changed)
+from collections import deque
+from timing import stage
+
+# Each command also has persist()/unpersist(), which History calls to mirror
+# apply()/revert() into a ProjectStore when the project is backed by one.
+
+
+class AddAnnotation:
+    def __init__(self, image_path, annotation):
+        self.image_path = image_path
+        self.annotation = annotation
+
+    def apply(self, target):
+        target.annotations.setdefault(self.image_path, []).append(self.annotation)
+
+    def revert(self, target):
+        # Commands are reverted in reverse order, so ours is always the last entry
+        anns = target.annotations[self.image_path]
+        anns.pop()
+        if not anns:
+            del target.annotations[self.image_path]
+
+    def persist(self, store, target):
+        store.add_annotation(self.image_path, self.annotation)
+
+    def unpersist(self, store, target):
+        store.delete_annotation(self.annotation)
+
+
+class RemoveAnnotation:
+    def __init__(self, image_path, index):
+        self.image_path = image_path
+        self.index = index
+        self.annotation = None
+
+    def apply(self, target):
+        anns = target.annotations[self.image_path]
+        self.annotation = anns.pop(self.index)
+        if not anns:
+            del target.annotations[self.image_path]
+
+    def revert(self, target):
+        target.annotations.setdefault(self.image_path, []).insert(self.index, self.annotation)
+
+    def persist(self, store, target):
+        store.delete_annotation(self.annotation)
+
+    def unpersist(self, store, target):
+        store.add_annotation(self.image_path, self.annotation)
+
+
+class RelabelAnnotation:
+    def __init__(self, image_path, index, new_class_id):
+        self.image_path = image_path
+        self.index = index
+        self.new_class_id = new_class_id
+        self.old_class_id = None
+        self.annotation = None
+
+    def apply(self, target):
+        self.annotation = target.annotations[self.image_path][self.index]
+        self.old_class_id = self.annotation.class_id
+        self.annotation.class_id = self.new_class_id
+
+    def revert(self, target):
+        self.annotation.class_id = self.old_class_id
+
+    def persist(self, store, target):
+        store.set_annotation_class(self.annotation)
+
+    def unpersist(self, store, target):
+        store.set_annotation_class(self.annotation)
+
+
+class AddClass:
+    image_path = None
+
+    def __init__(self, class_id, class_name):
+        self.class_id = class_id
+        self.class_name = class_name
+
+    def apply(self, target):
+        target.class_manager.add_class(self.class_id, self.class_name)
+
+    def revert(self, target):
+        del target.class_manager.classes[self.class_id]
+
+    def persist(self, store, target):
+        store.save_class(self.class_id, target.class_manager.classes[self.class_id])
+
+    def unpersist(self, store, target):
+        store.delete_class(self.class_id)
+
+
+class EditClass:
+    image_path = None
+
+    def __init__(self, old_id, new_id, new_name):
+        self.old_id = old_id
+        self.new_id = new_id
+        self.new_name = new_name
+        self.old_name = None
+        self.relabeled = None
+
+    def apply(self, target):
+        self.old_name = target.class_manager.get_class_info(self.old_id)['name']
+        target.class_manager.edit_class(self.old_id, self.new_id, self.new_name)
+        if self.old_id == self.new_id:
+            self.relabeled = []
+            return
+        # Rescanned on redo too: with a project store, images loaded after the
+        # undo are not in the earlier list
+        self.relabeled = [ann for anns in target.annotations.values()
+                          for ann in anns if ann.class_id == self.old_id]
+        for ann in self.relabeled:
+            ann.class_id = self.new_id
+
+    def revert(self, target):
+        target.class_manager.edit_class(self.new_id, self.old_id, self.old_name)
+        if self.old_id == self.new_id:
+            return
+        # Images loaded since apply() came from the store already relabeled, so
+        # they are not in self.relabeled; unpersist() moves the store back too
+        for anns in target.annotations.values():
+            for ann in anns:
+                if ann.class_id == self.new_id:
+                    ann.class_id = self.old_id
+
+    def persist(self, store, target):
+        # The SQL update also covers images that have not been loaded yet
+        if self.new_id != self.old_id:
+            store.delete_class(self.old_id)
+            store.relabel_class(self.old_id, self.new_id)
+        store.save_class(self.new_id, target.class_manager.classes[self.new_id])
+
+    def unpersist(self, store, target):
+        if self.new_id != self.old_id:
+            store.delete_class(self.new_id)
+            store.relabel_class(self.new_id, self.old_id)
+        store.save_class(self.old_id, target.class_manager.classes[self.old_id])
+
+
+class CommandGroup:
+    # Several commands that are applied, undone and redone as one step
+    image_path = None
+
+    def __init__(self, commands):
+        self.commands = list(commands)
+
+    def apply(self, target):
+        for command in self.commands:
+            command.apply(target)
+
+    def revert(self, target):
+        for command in reversed(self.commands):
+            command.revert(target)
+
+    def persist(self, store, target):
+        with store.batch():
+            for command in self.commands:
+                command.persist(store, target)
+
+    def unpersist(self, store, target):
+        with store.batch():
+            for command in reversed(self.commands):
+                command.unpersist(store, target)
+
+
+class History:
+    def __init__(self, max_depth=None, store=None):
+        self.max_depth = max_depth
+        self.store = store
+        self._done = deque(maxlen=max_depth)
+        self._undone = []
+
+    def execute(self, command, target):
+        # apply() raises before mutating anything on invalid input, so a failed
+        # command never reaches the history
+        with stage('save_state', action='execute', command=type(command).__name__):
+            command.apply(target)
+            if self.store is not None:
+                command.persist(self.store, target)
+        self._done.append(command)
+        self._undone.clear()
+        return command
+
+    def undo(self, target):
+        if not self._done:
+            return None
+        command = self._done.pop()
+        with stage('save_state', action='undo', command=type(command).__name__):
+            command.revert(target)
+            if self.store is not None:
+                command.unpersist(self.store, target)
+        self._undone.append(command)
+        return command
+
+    def redo(self, target):
+        if not self._undone:
+            return None
+        command = self._undone.pop()
+        with stage('save_state', action='redo', command=type(command).__name__):
+            command.apply(target)
+            if self.store is not None:
+                command.persist(self.store, target)
+        self._done.append(command)
+        return command
+
+    def can_undo(self):
+        return bool(self._done)
+
+    def can_redo(self):
+        return bool(self._undone)
+
+    def clear(self):
+        self._done.clear()
+        self._undone.clear()
@@ -0,0 +1,105 @@
+# image_cache.py (decoded-image cache with power-of-two zoom pyramids for canvas rendering)
+import math
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from PIL import Image
+from embedding_cache import image_cache_key
+from timing import stage
+
+# Serializes open_unchecked's temporary change of Image.MAX_IMAGE_PIXELS
+_pil_limit_lock = threading.Lock()
+
+
+@contextmanager
+def open_unchecked(image_path):
+    # Image.open without PIL's decompression bomb check, for images that are
+    # known to be large (aerial, microscopy). The limit is lifted only while
+    # the header is parsed; callers decide whether the pixels may be decoded.
+    with _pil_limit_lock:
+        limit = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = None
+        try:
+            img = Image.open(image_path)
+        finally:
+            Image.MAX_IMAGE_PIXELS = limit
+    with img:
+        yield img
+
+
+class ImagePyramid:
+    """Full-resolution image plus lazily built half-size levels (levels[k] is 1/2**k)."""
+
+    def __init__(self, image):
+        self.levels = [image]
+
+    @property
+    def image(self):
+        return self.levels[0]
+
+    @property
+    def size(self):
+        return self.levels[0].size
+
+    def level_for(self, zoom):
+        # Smallest level that is still at least as large as the requested zoom,
+        # so the final resample is always a downscale by less than 2x (or an upscale).
+        k = max(0, int(math.floor(math.log2(1.0 / zoom)))) if zoom < 1.0 else 0
+        while len(self.levels) <= k:
+            prev = self.levels[-1]
+            if min(prev.size) < 2:
+                break
+            self.levels.append(prev.reduce(2))
+        k = min(k, len(self.levels) - 1)
+        return k, self.levels[k]
+
+    def render(self, zoom, viewport, fast=False):
+        """Resample only the visible part of the image.
+
+        viewport is (x0, y0, x1, y1) in zoomed display coordinates. Returns the
+        rendered PIL image and its top-left corner in display coordinates, or
+        (None, None) if the viewport does not overlap the image.
+        """
+        w, h = self.size
+        display_w, display_h = int(w * zoom), int(h * zoom)
+        x0 = max(0, int(math.floor(viewport[0])))
+        y0 = max(0, int(math.floor(viewport[1])))
+        x1 = min(display_w, int(math.ceil(viewport[2])))
+        y1 = min(display_h, int(math.ceil(viewport[3])))
+        if x1 <= x0 or y1 <= y0:
+            return None, None
+
+        k, level = self.level_for(zoom)
+        scale = zoom * (2 ** k)
+        box = (x0 / scale, y0 / scale,
+               min(level.width, x1 / scale), min(level.height, y1 / scale))
+        resample = Image.BILINEAR if fast else Image.LANCZOS
+        if fast and scale >= 1.0:
+            resample = Image.NEAREST
+        return level.resize((x1 - x0, y1 - y0), resample, box=box), (x0, y0)
+
+
+class ImageCache:
+    def __init__(self, max_images=4):
+        self.max_images = max_images
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, image_path):
+        key = image_cache_key(image_path)
+        with self._lock:
+            pyramid = self._entries.get(key)
+            if pyramid is not None:
+                self._entries.move_to_end(key)
+                return pyramid
+        with stage('image_decode', path=image_path):
+            pyramid = ImagePyramid(Image.open(image_path).convert('RGB'))
+        with self._lock:
+            self._entries[key] = pyramid
+            while len(self._entries) > self.max_images:
+                self._entries.popitem(last=False)
+        return pyramid
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,212 @@
+# inference_server.py (one SAM model and embedding cache shared by several annotator GUIs over HTTP)
+import io
+import json
+import argparse
+import threading
+import urllib.parse
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+from sam_integration import load_sam_model, model_config, get_embedding, predict_batch
+from embedding_cache import EmbeddingCache
+from embedding_store import EmbeddingStore
+from remote_predictor import encode_masks
+
+DEFAULT_PORT = 8765
+SERVER_CACHE_BYTES = 2 * 1024 * 1024 * 1024
+
+
+class EmbeddingMissing(KeyError):
+    pass
+
+
+class DecodeJob:
+    __slots__ = ("cache_key", "prompts", "multimask_output", "masks", "scores", "error", "done")
+
+    def __init__(self, cache_key, prompts, multimask_output):
+        self.cache_key = cache_key
+        self.prompts = prompts
+        self.multimask_output = multimask_output
+        self.masks = None
+        self.scores = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class DecodeBatcher:
+    """Funnels every client's decode requests through one thread.
+
+    While the decoder is busy, new requests pile up; the next round takes all
+    of them and decodes the prompts of each image in a single predict_batch
+    call. SAM's mask decoder works against one image embedding per call, so
+    requests for different images are coalesced per image, not across images.
+    """
+
+    def __init__(self, predictor, cache):
+        self.predictor = predictor
+        self.cache = cache
+        self._jobs = []
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="decode-batcher", daemon=True)
+        self._thread.start()
+
+    def decode(self, cache_key, prompts, multimask_output=False):
+        job = DecodeJob(cache_key, prompts, multimask_output)
+        with self._cond:
+            self._jobs.append(job)
+            self._cond.notify()
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.masks, job.scores
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._jobs:
+                    self._cond.wait()
+                jobs, self._jobs = self._jobs, []
+            groups = OrderedDict()
+            for job in jobs:
+                groups.setdefault((job.cache_key, job.multimask_output), []).append(job)
+            for (cache_key, multimask_output), group in groups.items():
+                self._decode_group(cache_key, multimask_output, group)
+
+    def _decode_group(self, cache_key, multimask_output, group):
+        def missing():
+            raise EmbeddingMissing(cache_key)
+
+        try:
+            prompts = [prompt for job in group for prompt in job.prompts]
+            masks, scores = predict_batch(self.predictor, missing, prompts, self.cache, cache_key,
+                                          multimask_output)
+            start = 0
+            for job in group:
+                end = start + len(job.prompts)
+                job.masks, job.scores = masks[start:end], scores[start:end]
+                start = end
+        except Exception as e:
+            for job in group:
+                job.error = e
+        finally:
+            for job in group:
+                job.done.set()
+
+
+def prompt_from_json(prompt):
+    def as_array(value, dtype):
+        return None if value is None else np.asarray(value, dtype=dtype)
+    return {'points': as_array(prompt.get('points'), np.float32),
+            'labels': as_array(prompt.get('labels'), np.int64),
+            'box': as_array(prompt.get('box'), np.float32)}
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so a click costs one round trip and no connection setup
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == "/health":
+            self._send_json(200, {'status': 'ok', 'embeddings': len(self.server.cache)})
+        elif url.path == "/embedding":
+            key = urllib.parse.parse_qs(url.query).get('key', [''])[0]
+            self._send_json(200, {'cached': key in self.server.cache})
+        else:
+            self._send_json(404, {'error': f"unknown path {url.path}"})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            if self.path == "/embed":
+                self._embed(body)
+            elif self.path == "/predict":
+                self._predict(body)
+            else:
+                self._send_json(404, {'error': f"unknown path {self.path}"})
+        except EmbeddingMissing as e:
+            self._send_json(404, {'error': f"no embedding for {e.args[0]}"})
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {'error': str(e)})
+        except Exception as e:
+            self._send_json(500, {'error': str(e)})
+
+    def _embed(self, body):
+        key = self.headers.get('X-Cache-Key')
+        if not key:
+            raise ValueError("X-Cache-Key header is required")
+        cached = key in self.server.cache
+        if not cached:
+            image = np.load(io.BytesIO(body), allow_pickle=False)
+            get_embedding(self.server.predictor, image, self.server.cache, key)
+        self._send_json(200, {'cached': cached})
+
+    def _predict(self, body):
+        request = json.loads(body)
+        key = request['cache_key']
+        if key not in self.server.cache:
+            raise EmbeddingMissing(key)
+        prompts = [prompt_from_json(p) for p in request['prompts']]
+        masks, scores = self.server.batcher.decode(key, prompts, bool(request.get('multimask_output')))
+        self._send(200, encode_masks(masks, scores), "application/octet-stream")
+
+    def _send_json(self, status, payload):
+        self._send(status, json.dumps(payload).encode("utf-8"), "application/json")
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class InferenceServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, predictor, cache):
+        super().__init__(address, InferenceRequestHandler)
+        self.predictor = predictor
+        self.cache = cache
+        self.batcher = DecodeBatcher(predictor, cache)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve one SAM model to several annotator GUIs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--device", default=None, help="cpu or cuda (default: cuda if available)")
+    parser.add_argument("--quantize", action="store_true", help="int8 dynamic quantization (CPU only)")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--embedding-store", default=None, help="Directory written by precompute_embeddings.py")
+    parser.add_argument("--cache-bytes", type=int, default=SERVER_CACHE_BYTES,
+                        help="Memory budget for cached embeddings")
+    args = parser.parse_args()
+
+    model_options = {'quantize': args.quantize, 'num_threads': args.threads}
+    if args.device:
+        model_options['device'] = args.device
+    store = EmbeddingStore(args.embedding_store) if args.embedding_store else None
+    model = model_config(args.device, args.quantize)
+    if store is not None and not store.matches(model):
+        # Checked before the slow model load
+        raise ValueError(f"Embedding store {args.embedding_store} holds embeddings from "
+                         f"{store.model or 'an unrecorded model'}, not {model}")
+    predictor = load_sam_model(**model_options)
+    cache = EmbeddingCache(max_entries=None, max_bytes=args.cache_bytes, store=store)
+    cache.use_model(predictor.model_config)
+    server = InferenceServer((args.host, args.port), predictor, cache)
+    print(f"Inference server listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
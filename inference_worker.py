@@ -0,0 +1,189 @@
+# inference_worker.py (runs SAM clicks off the Tk thread; newer clicks supersede older ones)
+import queue
+import threading
+import itertools
+import numpy as np
+from sam_integration import generate_masks, predict_batch, resolve_predictor
+from annotation_processing import mask_to_annotation
+
+
+class InferenceRequest:
+    __slots__ = ("seq", "image_key", "image_path", "load_image", "points", "labels", "callback", "tiled",
+                 "prompts")
+
+    def __init__(self, seq, image_key, image_path, load_image, points, labels, callback, tiled=None,
+                 prompts=None):
+        self.seq = seq
+        self.image_key = image_key
+        self.image_path = image_path
+        self.load_image = load_image
+        self.points = points
+        self.labels = labels
+        self.callback = callback
+        # TiledImage for images too large to encode whole
+        self.tiled = tiled
+        # Several objects decoded together (see sam_integration.predict_batch);
+        # points/labels are unused when set
+        self.prompts = prompts
+
+
+class InferenceResult:
+    __slots__ = ("request", "masks", "annotation", "vertices", "error", "annotations", "scores")
+
+    def __init__(self, request, masks=None, annotation=None, vertices=None, error=None,
+                 annotations=None, scores=None):
+        self.request = request
+        self.masks = masks
+        self.annotation = annotation
+        # One annotation per decoded prompt for batch requests
+        self.annotations = annotations
+        self.scores = scores
+        # (before, after) simplification vertex counts
+        self.vertices = vertices
+        self.error = error
+
+
+class InferenceWorker:
+    def __init__(self, predictor, cache=None, mask_options=None):
+        self.predictor = predictor
+        self.cache = cache
+        # keyword arguments for mask_to_annotation (simplification, holes, min area)
+        self.mask_options = mask_options or {}
+        self._seq = itertools.count(1)
+        self._pending = {}
+        self._order = []
+        self._latest = {}
+        self._active = None
+        self._results = queue.Queue()
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="sam-inference", daemon=True)
+        self._thread.start()
+
+    def submit(self, image_key, image_path, load_image, points, labels, callback, tiled=None,
+               prompts=None):
+        with self._cond:
+            request = InferenceRequest(next(self._seq), image_key, image_path, load_image,
+                                       points, labels, callback, tiled, prompts)
+            # Only the newest click per image is worth computing
+            if image_key not in self._pending:
+                self._order.append(image_key)
+            self._pending[image_key] = request
+            self._latest[image_key] = request.seq
+            self._cond.notify()
+            return request
+
+    def cancel(self, image_key=None):
+        with self._cond:
+            if image_key is None:
+                keys = list(self._latest)
+                self._pending.clear()
+                self._order.clear()
+            else:
+                keys = [image_key]
+                self._pending.pop(image_key, None)
+                if image_key in self._order:
+                    self._order.remove(image_key)
+            # Bumping the latest seq also drops results that are already in flight
+            for key in keys:
+                self._latest[key] = next(self._seq)
+
+    def is_busy(self):
+        with self._cond:
+            return bool(self._pending) or self._active is not None
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def poll(self):
+        # Called from the Tk thread; returns finished results that are still current
+        results = []
+        while True:
+            try:
+                result = self._results.get_nowait()
+            except queue.Empty:
+                return results
+            if not self._is_stale(result.request):
+                results.append(result)
+
+    def _is_stale(self, request):
+        with self._cond:
+            return self._latest.get(request.image_key) != request.seq
+
+    def _run(self):
+        # The model may still be loading in the background; clicks queue up meanwhile
+        try:
+            self.predictor = resolve_predictor(self.predictor)
+            load_error = None
+        except Exception as e:
+            load_error = e
+        while True:
+            with self._cond:
+                while not self._order and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                request = self._pending.pop(self._order.pop(0))
+                self._active = request
+            try:
+                if load_error is not None:
+                    raise load_error
+                if request.prompts is not None:
+                    result = self._run_batch(request)
+                elif request.tiled is not None:
+                    annotation, before, after = request.tiled.segment(
+                        self.predictor, request.points, request.labels, self.cache, self.mask_options)
+                    result = InferenceResult(request, annotation=annotation, vertices=(before, after))
+                else:
+                    result = self._run_whole(request)
+            except Exception as e:
+                result = InferenceResult(request, error=e)
+            with self._cond:
+                self._active = None
+            if not self._is_stale(request):
+                self._results.put(result)
+
+    def _run_whole(self, request):
+        masks = generate_masks(self.predictor, request.load_image, request.points,
+                               request.labels, cache=self.cache, cache_key=request.image_key)
+        if masks is not None and len(masks) > 0:
+            annotation, before, after = mask_to_annotation(masks[0], **self.mask_options)
+            return InferenceResult(request, masks=masks, annotation=annotation,
+                                   vertices=(before, after))
+        return InferenceResult(request, masks=masks)
+
+    def _run_batch(self, request):
+        if request.tiled is not None:
+            return self._run_batch_tiled(request)
+        masks, scores = predict_batch(self.predictor, request.load_image, request.prompts,
+                                      cache=self.cache, cache_key=request.image_key)
+        annotations, before, after = [], 0, 0
+        for object_masks in masks:
+            annotation, b, a = mask_to_annotation(object_masks[0], **self.mask_options)
+            if annotation:
+                annotations.append(annotation)
+                before += b
+                after += a
+        return InferenceResult(request, masks=masks, annotations=annotations, scores=scores,
+                               vertices=(before, after))
+
+    def _run_batch_tiled(self, request):
+        # Each object may need different tiles encoded, so they are segmented one by one
+        annotations, before, after = [], 0, 0
+        for prompt in request.prompts:
+            points, labels = prompt.get('points'), prompt.get('labels')
+            if points is None or len(points) == 0:
+                # Tiles are picked by point: a box on its own is prompted at its centre
+                x0, y0, x1, y1 = prompt['box']
+                points, labels = [[(x0 + x1) / 2, (y0 + y1) / 2]], [1]
+            elif labels is None:
+                labels = np.ones(len(points), dtype=int)
+            annotation, b, a = request.tiled.segment(self.predictor, points, labels, self.cache,
+                                                     self.mask_options)
+            if annotation:
+                annotations.append(annotation)
+                before += b
+                after += a
+        return InferenceResult(request, annotations=annotations, vertices=(before, after))
@@ -0,0 +1,92 @@
+# load_test_server.py (simulates many annotators clicking against one inference_server.py)
+import time
+import argparse
+import threading
+import numpy as np
+from PIL import Image
+from remote_predictor import RemotePredictor
+from precompute_embeddings import find_images
+from embedding_cache import image_cache_key
+
+
+def synthetic_images(count, size, seed):
+    rng = np.random.default_rng(seed)
+    return [rng.integers(0, 256, (size, size, 3), dtype=np.uint8) for _ in range(count)]
+
+
+def run_client(url, images, clicks, seed, warm, cold, errors):
+    # One annotator: a few clicks on an image, then on to the next one
+    predictor = RemotePredictor(url)
+    rng = np.random.default_rng(seed)
+    clicks_per_image = max(1, clicks // len(images))
+    for image_index in range(clicks):
+        image, key = images[(seed + image_index // clicks_per_image) % len(images)]
+        if callable(image):
+            image = image()
+        h, w = image.shape[:2]
+        point = np.array([[rng.uniform(0, w), rng.uniform(0, h)]])
+        try:
+            first = not predictor.has_embedding(key)
+            start = time.perf_counter()
+            predictor.generate_masks(image, point, np.array([1]), key)
+        except Exception as e:
+            errors.append(e)
+            continue
+        (cold if first else warm).append(time.perf_counter() - start)
+
+
+def report(name, latencies):
+    if not latencies:
+        print(f"{name:>6}: no samples")
+        return
+    ms = np.array(latencies) * 1000
+    print(f"{name:>6}: n={len(ms):5d}  p50 {np.percentile(ms, 50):8.1f} ms  "
+          f"p99 {np.percentile(ms, 99):8.1f} ms  max {ms.max():8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent click-to-mask latency against an inference server")
+    parser.add_argument("--url", default="127.0.0.1:8765")
+    parser.add_argument("--clients", type=int, default=8, help="Simulated annotators")
+    parser.add_argument("--clicks", type=int, default=50, help="Clicks per client")
+    parser.add_argument("--image-dir", default=None, help="Images to click on (default: synthetic)")
+    parser.add_argument("--images", type=int, default=16, help="Number of images to use")
+    parser.add_argument("--synthetic-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    print(RemotePredictor(args.url).health())
+    if args.image_dir:
+        paths = find_images(args.image_dir)[:args.images]
+        # Clients only need numpy and PIL, not torch
+        images = [(lambda p=p: np.array(Image.open(p).convert('RGB')), image_cache_key(p)) for p in paths]
+    else:
+        images = [(image, f"load-test:{i}:{args.synthetic_size}")
+                  for i, image in enumerate(synthetic_images(args.images, args.synthetic_size, 0))]
+    if not images:
+        print("No images found")
+        return
+
+    warm, cold, errors = [], [], []
+    threads = [threading.Thread(target=run_client,
+                                args=(args.url, images, args.clicks, seed, warm, cold, errors))
+               for seed in range(args.clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    total = len(warm) + len(cold)
+    print(f"{args.clients} clients, {total} masks in {elapsed:.1f}s ({total / elapsed:.1f} masks/s), "
+          f"{len(errors)} errors")
+    # Cold clicks include uploading the image and running the encoder
+    report("warm", warm)
+    report("cold", cold)
+    report("all", warm + cold)
+    if errors:
+        print(f"First error: {errors[0]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# precompute_embeddings.py (headless entry point: encode a directory of images into an EmbeddingStore)
+import os
+import time
+import argparse
+import multiprocessing
+from embedding_cache import image_cache_key
+from embedding_store import EmbeddingStore
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+_predictor = None
+
+
+def find_images(image_dir):
+    paths = []
+    for root, _, files in os.walk(image_dir):
+        for name in files:
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(root, name))
+    return sorted(paths)
+
+
+def init_worker(device, threads):
+    # Each worker process owns its own model; torch threads are capped so that
+    # workers * threads does not oversubscribe the machine.
+    global _predictor
+    import torch
+    from sam_integration import load_sam_model
+    torch.set_num_threads(threads)
+    _predictor = load_sam_model(device)
+
+
+def encode_image(job):
+    from sam_integration import compute_embedding
+    from prefetch import load_image_array
+    key, image_path = job
+    start = time.perf_counter()
+    embedding = compute_embedding(_predictor, load_image_array(image_path))
+    return key, image_path, embedding, time.perf_counter() - start
+
+
+def precompute(image_dir, store_dir, workers=1, threads=None, device=None):
+    from sam_integration import default_device, model_config
+    # Resolved here so every worker loads the model the store is labelled with
+    device = device or default_device()
+    store = EmbeddingStore(store_dir, writable=True, model=model_config(device))
+    jobs = []
+    for image_path in find_images(image_dir):
+        key = image_cache_key(image_path)
+        if key not in store:
+            jobs.append((key, image_path))
+    print(f"{len(store)} images already embedded, {len(jobs)} to go")
+    if not jobs:
+        return store
+    store.reserve(len(store) + len(jobs))
+
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(workers, initializer=init_worker, initargs=(device, threads)) as pool:
+        for done, (key, image_path, embedding, seconds) in enumerate(
+                pool.imap_unordered(encode_image, jobs), 1):
+            store.add(key, embedding)
+            print(f"[{done}/{len(jobs)}] {image_path} ({seconds:.2f}s)")
+    return store
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute SAM image embeddings for a directory of images")
+    parser.add_argument("image_dir")
+    parser.add_argument("--store", required=True, help="Directory of the embedding store to create or resume")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+    parser.add_argument("--threads-per-worker", type=int, default=None, help="torch intra-op threads per worker")
+    parser.add_argument("--device", default=None, help="cpu or cuda (default: auto)")
+    args = parser.parse_args()
+    precompute(args.image_dir, args.store, args.workers, args.threads_per_worker, args.device)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# prefetch.py (background SAM embedding prefetch for the images around the current one)
+import time
+import threading
+import numpy as np
+from PIL import Image
+from sam_integration import get_embedding, resolve_predictor
+from embedding_cache import image_cache_key
+from tiled_inference import needs_tiling
+from dataset_export import read_image_size
+from timing import stage
+
+# 256x64x64 float32 - the size of a ViT-B/L/H image embedding
+DEFAULT_EMBEDDING_BYTES = 256 * 64 * 64 * 4
+
+
+def load_image_array(image_path):
+    with stage('image_decode', path=image_path):
+        return np.array(Image.open(image_path).convert('RGB'))
+
+
+class EmbeddingPrefetcher:
+    def __init__(self, predictor, cache, lookahead=2, max_bytes=256 * 1024 * 1024,
+                 should_wait=None):
+        self.predictor = predictor
+        self.cache = cache
+        self.lookahead = lookahead
+        self.max_bytes = max_bytes
+        self.embedding_bytes = DEFAULT_EMBEDDING_BYTES
+        # Interactive clicks share the model; back off while they are running
+        self.should_wait = should_wait
+        self._pending = []
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="embedding-prefetch", daemon=True)
+        self._thread.start()
+
+    def update(self, images, index):
+        # Rebuilding the queue on every move drops work for images that fell out of
+        # the window, which is what cancels pending jobs after a long jump.
+        with self._cond:
+            self._pending = self._plan(images, index)
+            self._cond.notify()
+
+    def cancel(self):
+        with self._cond:
+            self._pending = []
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._pending = []
+            self._cond.notify()
+
+    def _plan(self, images, index):
+        budget = max(1, self.max_bytes // self.embedding_bytes)
+        order = [index]
+        for offset in range(1, self.lookahead + 1):
+            order.extend((index + offset, index - offset))
+        paths = [images[i] for i in order if 0 <= i < len(images)]
+        return paths[:budget]
+
+    def _run(self):
+        try:
+            self.predictor = resolve_predictor(self.predictor)
+        except Exception:
+            return  # the inference worker reports the load failure
+        while True:
+            while self.should_wait is not None and self.should_wait() and not self._stopped:
+                time.sleep(0.05)
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                image_path = self._pending.pop(0)
+            try:
+                key = image_cache_key(image_path)
+                if key in self.cache:
+                    continue
+                # Large images are encoded per tile on click, never whole
+                if needs_tiling(read_image_size(image_path)):
+                    continue
+                embedding = get_embedding(self.predictor, lambda: load_image_array(image_path),
+                                          self.cache, key)
+                if embedding is not None:
+                    self.embedding_bytes = embedding.nbytes
+            except Exception as e:
+                print(f"Prefetch failed for {image_path}: {e}")
@@ -0,0 +1,264 @@
+# project_store.py (SQLite-backed project: every annotation edit is written as it happens)
+import sqlite3
+from collections.abc import Mapping
+from contextlib import contextmanager
+import numpy as np
+from annotation_processing import Annotation
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    width INTEGER,
+    height INTEGER
+);
+CREATE TABLE IF NOT EXISTS annotations (
+    id INTEGER PRIMARY KEY,
+    image_id INTEGER NOT NULL REFERENCES images(id),
+    class_id INTEGER NOT NULL,
+    contours BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS annotations_by_image ON annotations(image_id, id);
+CREATE INDEX IF NOT EXISTS annotations_by_class ON annotations(class_id);
+CREATE TABLE IF NOT EXISTS classes (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    color TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS auto_annotated (
+    image_id INTEGER PRIMARY KEY REFERENCES images(id),
+    masks INTEGER NOT NULL,
+    seconds REAL NOT NULL
+);
+"""
+# Stored in PRAGMA user_version; bumped whenever the stored layout changes.
+# 1: one flat polygon per row (column "polygon"); 2: contours without holes;
+# 3: contours plus holes (see encode_contours)
+SCHEMA_VERSION = 3
+
+CLASS_COLORS = [
+    '#FF0000', '#00FF00', '#0000FF', '#FFFF00', '#FF00FF',
+    '#00FFFF', '#800000', '#008000', '#000080', '#808000'
+]
+
+
+def encode_contours(contours, holes):
+    # int32 layout: [number of contours, number of holes, length of each ring...,
+    # x0, y0, x1, y1, ...] with the outer contours first
+    rings = contours + holes
+    header = np.array([len(contours), len(holes)] + [len(c) for c in rings], dtype=np.int32)
+    return b''.join([header.tobytes()] + [c.tobytes() for c in rings])
+
+
+def decode_contours(blob):
+    data = np.frombuffer(blob, dtype=np.int32)
+    n_contours, n_holes = int(data[0]), int(data[1])
+    offset = 2 + n_contours + n_holes
+    rings = []
+    for length in data[2:offset]:
+        rings.append(data[offset:offset + 2 * length].reshape(-1, 2))
+        offset += 2 * length
+    return rings[:n_contours], rings[n_contours:]
+
+
+def decode_polygon_v1(blob):
+    # Format 1: the x, y pairs of a single polygon
+    return np.frombuffer(blob, dtype=np.int32).reshape(-1, 2)
+
+
+def decode_contours_v2(blob):
+    # Format 2: [number of contours, length of each contour..., x0, y0, ...]
+    data = np.frombuffer(blob, dtype=np.int32)
+    count = int(data[0])
+    offset = 1 + count
+    contours = []
+    for length in data[1:1 + count]:
+        contours.append(data[offset:offset + 2 * length].reshape(-1, 2))
+        offset += 2 * length
+    return contours
+
+
+class ProjectStore:
+    """Annotations live on disk and are read per image on demand.
+
+    Each write is committed immediately (WAL journal), so a crash loses at most
+    the action in progress. Annotations keep their row id in ann.db_id; undo
+    re-inserts a removed row under the same id, which keeps per-image order.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+        self.conn.executescript(SCHEMA)
+        self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.conn.commit()
+        self._image_ids = {}
+        self._batch_depth = 0
+
+    def _migrate(self):
+        # Brings project files written by older versions to the current layout
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise ValueError(f"{self.path} uses project format {version}, newer than this version "
+                             f"supports ({SCHEMA_VERSION})")
+        if version == 1:
+            self.conn.execute("ALTER TABLE annotations RENAME COLUMN polygon TO contours")
+            self._rewrite_contours(lambda blob: encode_contours([decode_polygon_v1(blob)], []))
+        elif version == 2:
+            self._rewrite_contours(lambda blob: encode_contours(decode_contours_v2(blob), []))
+        self.conn.commit()
+
+    def _rewrite_contours(self, convert):
+        rows = self.conn.execute("SELECT id, contours FROM annotations").fetchall()
+        self.conn.executemany("UPDATE annotations SET contours = ? WHERE id = ?",
+                              [(convert(blob), ann_id) for ann_id, blob in rows])
+
+    def close(self):
+        self._commit()
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.conn.close()
+
+    @contextmanager
+    def batch(self):
+        # Groups many writes (bulk imports, auto-annotation) into one transaction
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            self._commit()
+
+    def _commit(self):
+        if self._batch_depth == 0:
+            self.conn.commit()
+
+    # Images
+
+    def add_images(self, image_paths):
+        self.conn.executemany("INSERT OR IGNORE INTO images (path) VALUES (?)",
+                              [(path,) for path in image_paths])
+        self._commit()
+
+    def image_paths(self):
+        return [row[0] for row in self.conn.execute("SELECT path FROM images ORDER BY id")]
+
+    def set_image_size(self, image_path, width, height):
+        self.conn.execute("UPDATE images SET width = ?, height = ? WHERE id = ?",
+                          (width, height, self._image_id(image_path)))
+        self._commit()
+
+    def image_sizes(self):
+        return {path: (w, h) for path, w, h in self.conn.execute(
+            "SELECT path, width, height FROM images WHERE width IS NOT NULL")}
+
+    def _image_id(self, image_path):
+        image_id = self._image_ids.get(image_path)
+        if image_id is None:
+            row = self.conn.execute("SELECT id FROM images WHERE path = ?", (image_path,)).fetchone()
+            if row is None:
+                image_id = self.conn.execute("INSERT INTO images (path) VALUES (?)",
+                                             (image_path,)).lastrowid
+            else:
+                image_id = row[0]
+            self._image_ids[image_path] = image_id
+        return image_id
+
+    # Annotations
+
+    def add_annotation(self, image_path, ann):
+        cursor = self.conn.execute(
+            "INSERT INTO annotations (id, image_id, class_id, contours) VALUES (?, ?, ?, ?)",
+            (ann.db_id, self._image_id(image_path), ann.class_id, encode_contours(ann.contours, ann.holes)))
+        ann.db_id = cursor.lastrowid
+        self._commit()
+        return ann.db_id
+
+    def delete_annotation(self, ann):
+        self.conn.execute("DELETE FROM annotations WHERE id = ?", (ann.db_id,))
+        self._commit()
+
+    def set_annotation_class(self, ann):
+        self.conn.execute("UPDATE annotations SET class_id = ? WHERE id = ?",
+                          (ann.class_id, ann.db_id))
+        self._commit()
+
+    def relabel_class(self, old_id, new_id):
+        self.conn.execute("UPDATE annotations SET class_id = ? WHERE class_id = ?", (new_id, old_id))
+        self._commit()
+
+    def load_annotations(self, image_path):
+        rows = self.conn.execute(
+            "SELECT a.id, a.class_id, a.contours FROM annotations a JOIN images i ON a.image_id = i.id "
+            "WHERE i.path = ? ORDER BY a.id", (image_path,))
+        anns = []
+        for ann_id, class_id, blob in rows:
+            contours, holes = decode_contours(blob)
+            anns.append(Annotation(contours, class_id, ann_id, holes=holes))
+        return anns
+
+    def annotated_paths(self):
+        return [row[0] for row in self.conn.execute(
+            "SELECT path FROM images WHERE EXISTS "
+            "(SELECT 1 FROM annotations WHERE annotations.image_id = images.id) ORDER BY id")]
+
+    def annotated_count(self):
+        return self.conn.execute("SELECT COUNT(DISTINCT image_id) FROM annotations").fetchone()[0]
+
+    def annotations_view(self):
+        return AnnotationsView(self)
+
+    # Classes
+
+    def load_classes(self):
+        return {cid: {"name": name, "color": color}
+                for cid, name, color in self.conn.execute("SELECT id, name, color FROM classes")}
+
+    def save_class(self, class_id, info):
+        self.conn.execute("INSERT OR REPLACE INTO classes (id, name, color) VALUES (?, ?, ?)",
+                          (class_id, info['name'], info['color']))
+        self._commit()
+
+    def delete_class(self, class_id):
+        self.conn.execute("DELETE FROM classes WHERE id = ?", (class_id,))
+        self._commit()
+
+    def ensure_class(self, class_id, class_name):
+        self.conn.execute("INSERT OR IGNORE INTO classes (id, name, color) VALUES (?, ?, ?)",
+                          (class_id, class_name, CLASS_COLORS[class_id % len(CLASS_COLORS)]))
+        self._commit()
+
+    # Batch auto-annotation progress
+
+    def mark_auto_annotated(self, image_path, masks, seconds):
+        self.conn.execute("INSERT OR REPLACE INTO auto_annotated (image_id, masks, seconds) VALUES (?, ?, ?)",
+                          (self._image_id(image_path), masks, seconds))
+        self._commit()
+
+    def auto_annotated_paths(self):
+        return {row[0] for row in self.conn.execute(
+            "SELECT i.path FROM auto_annotated a JOIN images i ON a.image_id = i.id")}
+
+
+class AnnotationsView(Mapping):
+    """Read-only {image_path: [annotation, ...]} over the store, for the exporters."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, image_path):
+        anns = self.store.load_annotations(image_path)
+        if not anns:
+            raise KeyError(image_path)
+        return anns
+
+    def __iter__(self):
+        for row in self.store.conn.execute(
+                "SELECT path FROM images WHERE EXISTS "
+                "(SELECT 1 FROM annotations WHERE annotations.image_id = images.id) ORDER BY id"):
+            yield row[0]
+
+    def __len__(self):
+        return self.store.annotated_count()
@@ -0,0 +1,147 @@
+# propagation.py (carries accepted annotations from one video frame to the next as SAM prompts)
+import threading
+import cv2
+import numpy as np
+from sam_integration import predict_batch, resolve_predictor
+from embedding_cache import image_cache_key
+from annotation_processing import mask_to_annotation
+from spatial_index import contains_point
+from tiled_inference import TiledImage, interior_point, needs_tiling
+from dataset_export import read_image_size
+
+# Objects move between frames: the previous box is grown by this fraction per side
+PROPAGATION_BOX_MARGIN = 0.1
+# Proposals the decoder itself scores lower than this are dropped (object left the frame)
+PROPAGATION_MIN_SCORE = 0.6
+
+
+def annotation_to_prompt(annotation, margin=PROPAGATION_BOX_MARGIN):
+    """Box plus one positive point for the same object in the next frame."""
+    x0, y0, x1, y1 = annotation.bbox
+    dx, dy = (x1 - x0) * margin, (y1 - y0) * margin
+    box = np.array([x0 - dx, y0 - dy, x1 + dx, y1 + dy], dtype=np.float32)
+
+    largest = max(annotation.contours, key=lambda c: cv2.contourArea(c.reshape(-1, 1, 2)))
+    moments = cv2.moments(largest.reshape(-1, 1, 2))
+    if moments['m00'] and contains_point(annotation, moments['m10'] / moments['m00'],
+                                         moments['m01'] / moments['m00']):
+        point = (moments['m10'] / moments['m00'], moments['m01'] / moments['m00'])
+    else:
+        # Concave shape whose centroid falls outside it: use its most interior pixel
+        region = np.zeros((y1 - y0 + 1, x1 - x0 + 1), np.uint8)
+        cv2.fillPoly(region, [c - (x0, y0) for c in annotation.contours], 1)
+        if annotation.holes:
+            cv2.fillPoly(region, [h - (x0, y0) for h in annotation.holes], 0)
+        px, py = interior_point(region)
+        point = (x0 + px, y0 + py)
+    return {'points': np.array([point], dtype=np.float32), 'labels': np.array([1]), 'box': box,
+            'class_id': annotation.class_id}
+
+
+class Propagator:
+    """Decodes the previous frame's objects on the next frame in the background.
+
+    propose() may be called again for the same frame (the source frame was
+    edited); only the newest proposal for a frame is kept. Finished frames are
+    reported by poll() and their annotations handed out once by take().
+    """
+
+    def __init__(self, predictor, cache=None, mask_options=None):
+        self.predictor = predictor
+        self.cache = cache
+        self.mask_options = {k: v for k, v in (mask_options or {}).items() if k != 'class_id'}
+        self._versions = {}
+        self._pending = {}
+        self._results = {}
+        self._finished = []
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="propagation", daemon=True)
+        self._thread.start()
+
+    def propose(self, annotations, target_path, load_image):
+        with self._cond:
+            version = self._versions.get(target_path, 0) + 1
+            self._versions[target_path] = version
+            self._results.pop(target_path, None)
+            self._pending[target_path] = (version, [annotation_to_prompt(a) for a in annotations if a],
+                                          load_image)
+            self._cond.notify()
+
+    def is_pending(self, target_path):
+        with self._cond:
+            return target_path in self._pending or target_path in self._results
+
+    def discard(self, target_path):
+        with self._cond:
+            self._versions[target_path] = self._versions.get(target_path, 0) + 1
+            self._pending.pop(target_path, None)
+            self._results.pop(target_path, None)
+
+    def take(self, target_path):
+        with self._cond:
+            return self._results.pop(target_path, None)
+
+    def poll(self):
+        with self._cond:
+            finished, self._finished = self._finished, []
+            return [path for path in finished if path in self._results]
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def _run(self):
+        try:
+            self.predictor = resolve_predictor(self.predictor)
+        except Exception:
+            return  # the inference worker reports the load failure
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                target_path = next(iter(self._pending))
+                version, prompts, load_image = self._pending.pop(target_path)
+            try:
+                annotations = self._decode(target_path, prompts, load_image)
+            except Exception as e:
+                print(f"Propagation failed for {target_path}: {e}")
+                annotations = []
+            with self._cond:
+                if self._versions.get(target_path) == version:
+                    self._results[target_path] = annotations
+                    self._finished.append(target_path)
+
+    def _decode(self, target_path, prompts, load_image):
+        if not prompts:
+            return []
+        if needs_tiling(read_image_size(target_path)):
+            return self._decode_tiled(target_path, prompts)
+        # All objects of the frame go through the mask decoder in one batch
+        masks, scores = predict_batch(self.predictor, load_image, prompts, cache=self.cache,
+                                      cache_key=image_cache_key(target_path))
+        annotations = []
+        for prompt, object_masks, object_scores in zip(prompts, masks, scores):
+            if object_scores[0] < PROPAGATION_MIN_SCORE:
+                continue
+            annotation, _, _ = mask_to_annotation(object_masks[0], class_id=prompt['class_id'],
+                                                  **self.mask_options)
+            if annotation:
+                annotations.append(annotation)
+        return annotations
+
+    def _decode_tiled(self, target_path, prompts):
+        # Large frames go through the same tiles as clicks, one object at a time.
+        # Tiles are picked by point, so the box is not used, and there is no
+        # decoder score to filter on: objects that left the frame give no mask.
+        tiled = TiledImage(target_path)
+        annotations = []
+        for prompt in prompts:
+            annotation, _, _ = tiled.segment(self.predictor, prompt['points'], prompt['labels'], self.cache,
+                                             dict(self.mask_options, class_id=prompt['class_id']))
+            if annotation:
+                annotations.append(annotation)
+        return annotations
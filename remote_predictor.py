@@ -0,0 +1,135 @@
+# remote_predictor.py (client for inference_server.py: a predictor that lives in another process)
+import io
+import json
+import threading
+import http.client
+import urllib.parse
+from concurrent.futures import Future
+import numpy as np
+from embedding_cache import array_cache_key
+
+
+def prompt_to_json(prompt):
+    def as_list(value):
+        return None if value is None else np.asarray(value).tolist()
+    return {'points': as_list(prompt.get('points')), 'labels': as_list(prompt.get('labels')),
+            'box': as_list(prompt.get('box'))}
+
+
+def encode_masks(masks, scores):
+    # Masks are sent bit-packed: 8x smaller than bool arrays, and cheap to undo
+    buf = io.BytesIO()
+    np.savez(buf, masks=np.packbits(masks.ravel()), shape=np.array(masks.shape, dtype=np.int64),
+             scores=np.asarray(scores, dtype=np.float32))
+    return buf.getvalue()
+
+
+def decode_masks(data):
+    with np.load(io.BytesIO(data)) as npz:
+        shape = tuple(int(n) for n in npz['shape'])
+        masks = np.unpackbits(npz['masks'], count=int(np.prod(shape))).reshape(shape).astype(bool)
+        return masks, npz['scores']
+
+
+class RemotePredictor:
+    """Stands in for a SamPredictor; sam_integration forwards calls here when is_remote is set.
+
+    The server keeps the embeddings. An image is only uploaded when the
+    server does not have its cache key. Each thread keeps its own
+    keep-alive connection.
+    """
+    is_remote = True
+
+    def __init__(self, url, timeout=120):
+        parsed = urllib.parse.urlsplit(url if "://" in url else "http://" + url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 8765
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _request(self, method, path, body=None, headers=None):
+        for attempt in range(2):
+            conn = getattr(self._local, "conn", None)
+            if conn is None:
+                conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                response = conn.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, ConnectionError):
+                # The server closed an idle keep-alive connection: reconnect once
+                conn.close()
+                self._local.conn = None
+                if attempt:
+                    raise
+
+    def _error(self, status, data):
+        try:
+            message = json.loads(data)['error']
+        except (ValueError, KeyError):
+            message = data[:200]
+        return RuntimeError(f"Inference server error {status}: {message}")
+
+    def health(self):
+        status, data = self._request("GET", "/health")
+        if status != 200:
+            raise self._error(status, data)
+        return json.loads(data)
+
+    def has_embedding(self, cache_key):
+        status, data = self._request("GET", "/embedding?key=" + urllib.parse.quote(cache_key))
+        return status == 200 and json.loads(data)['cached']
+
+    def ensure_embedding(self, image_array, cache_key=None, check=True):
+        if cache_key is not None and check and self.has_embedding(cache_key):
+            return cache_key
+        if callable(image_array):
+            image_array = image_array()
+        cache_key = cache_key or array_cache_key(image_array)
+        buf = io.BytesIO()
+        np.save(buf, np.ascontiguousarray(image_array))
+        status, data = self._request("POST", "/embed", body=buf.getvalue(),
+                                     headers={"X-Cache-Key": cache_key,
+                                              "Content-Type": "application/octet-stream"})
+        if status != 200:
+            raise self._error(status, data)
+        return cache_key
+
+    def predict_batch(self, image_array, prompts, cache_key=None, multimask_output=False):
+        if cache_key is None:
+            if callable(image_array):
+                image_array = image_array()
+            cache_key = array_cache_key(image_array)
+        body = json.dumps({'cache_key': cache_key, 'multimask_output': multimask_output,
+                           'prompts': [prompt_to_json(p) for p in prompts]}).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        status, data = self._request("POST", "/predict", body=body, headers=headers)
+        if status == 404:
+            # The server has never seen this image (or evicted it): upload and retry once
+            self.ensure_embedding(image_array, cache_key, check=False)
+            status, data = self._request("POST", "/predict", body=body, headers=headers)
+        if status != 200:
+            raise self._error(status, data)
+        return decode_masks(data)
+
+    def generate_masks(self, image_array, points, labels, cache_key=None):
+        masks, _ = self.predict_batch(image_array, [{'points': points, 'labels': labels, 'box': None}],
+                                      cache_key)
+        return masks[0]
+
+
+def connect_remote_predictor_async(url):
+    # Same contract as load_sam_model_async: a Future resolving to a predictor,
+    # failing if the server cannot be reached
+    future = Future()
+
+    def connect():
+        try:
+            predictor = RemotePredictor(url)
+            predictor.health()
+            future.set_result(predictor)
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=connect, name="inference-server-connect", daemon=True).start()
+    return future
@@ -1,52 +1,210 @@
 # sam_integration.py (SAM model handling)
+import threading
+from concurrent.futures import Future
 import torch
 from segment_anything import sam_model_registry, SamPredictor
 import numpy as np
 from segment_anything.utils.transforms import ResizeLongestSide
+from embedding_cache import ImageEmbedding, array_cache_key
+from timing import stage
 
-def load_sam_model(device="cuda" if torch.cuda.is_available() else "cpu"):
-    
+# SamPredictor keeps the active embedding as mutable state, so swapping it in and
+# decoding against it has to happen as one step when several threads share a model.
+predictor_lock = threading.RLock()
+
+# Prompts per batched mask decoder call in predict_batch; bounds the size of
+# the full-resolution mask tensor
+DECODE_BATCH_SIZE = 64
+
+def default_device():
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+def model_config(device=None, quantize=False):
+    # The model load_sam_model builds for these options; embedding stores record
+    # it so that embeddings from another model are never reused
+    device = device or default_device()
     if device == "cuda":
-        sam_checkpoint = "sam_vit_h_4b8939.pth"
-        model_type = "vit_h"
-    else:
-        sam_checkpoint = "sam_vit_b_01ec64.pth"
-        model_type = "vit_b"
+        return {"model_type": "vit_h", "checkpoint": "sam_vit_h_4b8939.pth", "quantize": False}
+    return {"model_type": "vit_b", "checkpoint": "sam_vit_b_01ec64.pth",
+            "quantize": bool(quantize) and device == "cpu"}
+
+def load_sam_model(device=None, quantize=False, num_threads=None, mmap=True):
+    # quantize: int8 dynamic quantization of the image encoder's Linear layers
+    # (CPU only); num_threads: torch intra-op threads; mmap: map the checkpoint
+    # instead of reading it into memory before copying it into the model
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+    device = device or default_device()
+    config = model_config(device, quantize)
+    sam_checkpoint = config["checkpoint"]
+    model_type = config["model_type"]
 
     print(f"Using Device: {device} and Model: {sam_checkpoint},Type: {model_type}")
-    sam = sam_model_registry[model_type](checkpoint=sam_checkpoint)
+    sam = sam_model_registry[model_type]()
+    sam.load_state_dict(load_checkpoint(sam_checkpoint, mmap))
+    sam.eval()
+    if quantize:
+        if device == "cpu":
+            torch.ao.quantization.quantize_dynamic(sam.image_encoder, {torch.nn.Linear},
+                                                   dtype=torch.qint8, inplace=True)
+        else:
+            print("int8 quantization is CPU only; loading float weights")
     sam.to(device=device)
-    return SamPredictor(sam)
-
-def generate_masks(predictor, image_array, input_point, input_label=np.array([1])):
-
-    try:
-        predictor.set_image(image_array)
-        
-        masks, scores, _ = predictor.predict(
-            point_coords=input_point,
-            point_labels=input_label,
-            multimask_output=False,
-        )
-        print(f"Masks: {len(masks)}")
-        return masks
-    
-    except:
-        # Transform image to SAM's expected format
-        transform = ResizeLongestSide(1024)
-        input_image = transform.apply_image(image_array)
-        input_image_torch = torch.as_tensor(input_image, device=predictor.device)
-        input_image_torch = input_image_torch.permute(2, 0, 1).contiguous()[None, :, :, :]
-        
-        # Preprocess image
-        predictor.set_torch_image(input_image_torch, image_array.shape[:2])
-        
-        # Transform coordinates
-        input_point = transform.apply_coords(input_point, image_array.shape[:2])
-        masks, scores, _ = predictor.predict(
-            point_coords=input_point,
-            point_labels=np.array([1]),
-            multimask_output=False,
-        )
-        print(f"Masks: {len(masks)}")
+    predictor = SamPredictor(sam)
+    predictor.model_config = config
+    return predictor
+
+def load_checkpoint(path, mmap=True):
+    if mmap:
+        try:
+            return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+        except (TypeError, RuntimeError):
+            pass  # torch < 2.1, or a checkpoint not in the zip format
+    with open(path, "rb") as f:
+        return torch.load(f, map_location="cpu")
+
+def load_sam_model_async(**kwargs):
+    # Loads the model on a background thread; the returned Future is accepted
+    # wherever a predictor is, and resolved by the thread that first needs it
+    future = Future()
+
+    def load():
+        try:
+            future.set_result(load_sam_model(**kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=load, name="sam-model-load", daemon=True).start()
+    return future
+
+def resolve_predictor(predictor):
+    return predictor.result() if isinstance(predictor, Future) else predictor
+
+def compute_embedding(predictor, image_array):
+    with predictor_lock, stage('set_image', shape=image_array.shape):
+        try:
+            predictor.set_image(image_array)
+        except Exception:
+            # Transform image to SAM's expected format
+            transform = ResizeLongestSide(1024)
+            input_image = transform.apply_image(image_array)
+            input_image_torch = torch.as_tensor(input_image, device=predictor.device)
+            input_image_torch = input_image_torch.permute(2, 0, 1).contiguous()[None, :, :, :]
+
+            # Preprocess image
+            predictor.set_torch_image(input_image_torch, image_array.shape[:2])
+
+        embedding = ImageEmbedding(predictor.features.detach().cpu().numpy(),
+                                   predictor.original_size, predictor.input_size)
+        predictor.active_embedding = embedding
+        return embedding
+
+def apply_embedding(predictor, embedding):
+    # Loads a cached embedding into the predictor so only the prompt encoder and
+    # mask decoder run on the next predict() call.
+    with predictor_lock:
+        if getattr(predictor, "active_embedding", None) is embedding:
+            return
+        predictor.reset_image()
+        predictor.features = torch.as_tensor(embedding.features, device=predictor.device)
+        predictor.original_size = embedding.original_size
+        predictor.input_size = embedding.input_size
+        predictor.is_image_set = True
+        predictor.active_embedding = embedding
+
+def get_embedding(predictor, image_array, cache=None, cache_key=None):
+    if getattr(predictor, "is_remote", False):
+        # The inference server owns the embeddings; this only makes sure it has one
+        predictor.ensure_embedding(image_array, cache_key)
+        return None
+    # image_array may be a zero-argument callable so callers only decode the image on a miss
+    if cache is not None and cache_key is not None:
+        embedding = cache.get(cache_key)
+        if embedding is not None:
+            return embedding
+    if callable(image_array):
+        image_array = image_array()
+    if cache is not None and cache_key is None:
+        cache_key = array_cache_key(image_array)
+    with predictor_lock:
+        # Another thread may have encoded the same image while we waited for the model
+        if cache is not None:
+            embedding = cache.get(cache_key)
+            if embedding is not None:
+                return embedding
+        embedding = compute_embedding(predictor, image_array)
+        if cache is not None:
+            cache.put(cache_key, embedding)
+        return embedding
+
+def generate_masks(predictor, image_array, input_point, input_label=np.array([1]),
+                   cache=None, cache_key=None):
+    if getattr(predictor, "is_remote", False):
+        return predictor.generate_masks(image_array, input_point, input_label, cache_key)
+    with predictor_lock:
+        embedding = get_embedding(predictor, image_array, cache, cache_key)
+        apply_embedding(predictor, embedding)
+
+        with stage('predict', points=len(input_point)) as fields:
+            masks, scores, _ = predictor.predict(
+                point_coords=input_point,
+                point_labels=input_label,
+                multimask_output=False,
+            )
+            fields['masks'] = len(masks)
         return masks
+
+def predict_batch(predictor, image_array, prompts, cache=None, cache_key=None,
+                  multimask_output=False, batch_size=DECODE_BATCH_SIZE):
+    """Decodes many prompts against one image embedding in batched decoder calls.
+
+    Each prompt is a dict with optional 'points' (N, 2), 'labels' (N,) and
+    'box' (x0, y0, x1, y1) in original image coordinates; missing labels mean
+    positive points. Returns masks (B, C, H, W) and scores (B, C) in prompt
+    order, where C is 3 with multimask_output and 1 otherwise.
+    """
+    if not prompts:
+        return np.empty((0, 1, 0, 0), bool), np.empty((0, 1), np.float32)
+    if getattr(predictor, "is_remote", False):
+        return predictor.predict_batch(image_array, prompts, cache_key, multimask_output)
+    with predictor_lock:
+        embedding = get_embedding(predictor, image_array, cache, cache_key)
+        apply_embedding(predictor, embedding)
+        masks, scores = [None] * len(prompts), [None] * len(prompts)
+        with stage('predict_batch', prompts=len(prompts), multimask=multimask_output):
+            # The decoder adds a box embedding to every prompt of a call, so prompts
+            # with and without a box are batched separately
+            for with_box in (True, False):
+                group = [i for i, p in enumerate(prompts) if (p.get('box') is not None) == with_box]
+                for start in range(0, len(group), batch_size):
+                    chunk = group[start:start + batch_size]
+                    chunk_masks, chunk_scores = _decode_prompts(predictor, [prompts[i] for i in chunk],
+                                                                multimask_output)
+                    for k, i in enumerate(chunk):
+                        masks[i], scores[i] = chunk_masks[k], chunk_scores[k]
+        return np.stack(masks), np.stack(scores)
+
+def _decode_prompts(predictor, prompts, multimask_output):
+    point_coords = point_labels = boxes = None
+    n_points = max(len(p['points']) if p.get('points') is not None else 0 for p in prompts)
+    if n_points:
+        # Shorter point sets are padded with label -1, which the prompt encoder ignores
+        coords = np.zeros((len(prompts), n_points, 2), np.float32)
+        labels = np.full((len(prompts), n_points), -1, np.int64)
+        for k, prompt in enumerate(prompts):
+            if prompt.get('points') is None:
+                continue
+            points = np.asarray(prompt['points'], np.float32).reshape(-1, 2)
+            coords[k, :len(points)] = points
+            labels[k, :len(points)] = prompt['labels'] if prompt.get('labels') is not None else 1
+        coords = predictor.transform.apply_coords(coords, predictor.original_size)
+        point_coords = torch.as_tensor(coords, dtype=torch.float, device=predictor.device)
+        point_labels = torch.as_tensor(labels, dtype=torch.int, device=predictor.device)
+    if prompts[0].get('box') is not None:
+        box = torch.as_tensor(np.array([p['box'] for p in prompts], np.float32), device=predictor.device)
+        boxes = predictor.transform.apply_boxes_torch(box, predictor.original_size)
+
+    masks, scores, _ = predictor.predict_torch(point_coords, point_labels, boxes,
+                                               multimask_output=multimask_output)
+    return masks.cpu().numpy(), scores.float().cpu().numpy()
@@ -0,0 +1,162 @@
+# spatial_index.py (uniform grid over annotation bboxes: hit-testing, viewport queries, overlap checks)
+import cv2
+import numpy as np
+
+GRID_CELL_SIZE = 128
+# Overlap IoU is measured on a raster whose longer side is at most this many pixels
+IOU_RASTER_SIZE = 512
+
+
+def contains_point(annotation, x, y):
+    def inside(ring):
+        return cv2.pointPolygonTest(ring.reshape(-1, 1, 2), (float(x), float(y)), False) >= 0
+    return any(inside(c) for c in annotation.contours) and not any(inside(h) for h in annotation.holes)
+
+
+def perimeter(annotation):
+    return sum(float(np.sqrt((np.diff(ring, axis=0, append=ring[:1]) ** 2).sum(axis=1)).sum())
+               for ring in annotation.contours + annotation.holes)
+
+
+def _raster_frame(a, b):
+    # Union of the two bboxes and the scale mask_iou rasterizes them at
+    x0, y0 = min(a.bbox[0], b.bbox[0]), min(a.bbox[1], b.bbox[1])
+    x1, y1 = max(a.bbox[2], b.bbox[2]) + 1, max(a.bbox[3], b.bbox[3]) + 1
+    return x0, y0, x1, y1, min(1.0, IOU_RASTER_SIZE / max(x1 - x0, y1 - y0))
+
+
+def iou_upper_bound(a, b):
+    """An upper bound on mask_iou(a, b) from bboxes and polygon areas only.
+
+    IoU <= min(area, bbox intersection) / max(area). Areas are widened by the
+    perimeter (in raster pixels) to cover the boundary pixels and vertex
+    rounding of the raster, which matter most for small objects.
+    """
+    scale = _raster_frame(a, b)[4]
+    # Bbox overlap in raster pixels; bboxes a few pixels apart can still meet
+    # after downscaling and rounding
+    ix = scale * (min(a.bbox[2], b.bbox[2]) - max(a.bbox[0], b.bbox[0])) + 2
+    iy = scale * (min(a.bbox[3], b.bbox[3]) - max(a.bbox[1], b.bbox[1])) + 2
+    if ix <= 0 or iy <= 0:
+        return 0.0
+    high, low = [], []
+    for annotation in (a, b):
+        area, edge = scale * scale * annotation.area, scale * perimeter(annotation)
+        high.append(area + edge + 1)
+        low.append(area - edge)
+    intersection = min(high + [ix * iy])
+    return intersection / max(low) if max(low) > 0 else 1.0
+
+
+def mask_iou(a, b):
+    # IoU of two annotations, rasterized over the union of their bboxes
+    x0, y0, x1, y1, scale = _raster_frame(a, b)
+    shape = (max(1, int(np.ceil((y1 - y0) * scale))), max(1, int(np.ceil((x1 - x0) * scale))))
+
+    def rasterize(annotation):
+        mask = np.zeros(shape, np.uint8)
+        offset = np.array([x0, y0])
+        cv2.fillPoly(mask, [np.round((c - offset) * scale).astype(np.int32) for c in annotation.contours], 1)
+        if annotation.holes:
+            cv2.fillPoly(mask, [np.round((h - offset) * scale).astype(np.int32) for h in annotation.holes], 0)
+        return mask.astype(bool)
+
+    ma, mb = rasterize(a), rasterize(b)
+    union = np.logical_or(ma, mb).sum()
+    return float(np.logical_and(ma, mb).sum() / union) if union else 0.0
+
+
+class SpatialIndex:
+    """Annotations of one image bucketed by the grid cells their bbox covers.
+
+    Queries only look at the cells under the point or box, so their cost
+    depends on how crowded that area is, not on how many annotations the
+    image has. Annotations are tracked by identity and must not change
+    geometry while indexed (annotations are never edited in place).
+    """
+
+    def __init__(self, cell_size=GRID_CELL_SIZE):
+        self.cell_size = cell_size
+        self._cells = {}
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, annotation):
+        return id(annotation) in self._entries
+
+    def _cell_range(self, x0, y0, x1, y1):
+        c = self.cell_size
+        return range(int(x0 // c), int(x1 // c) + 1), range(int(y0 // c), int(y1 // c) + 1)
+
+    def add(self, annotation):
+        if id(annotation) in self._entries or not annotation:
+            return
+        cols, rows = self._cell_range(*annotation.bbox)
+        cells = [(cx, cy) for cx in cols for cy in rows]
+        for cell in cells:
+            self._cells.setdefault(cell, []).append(annotation)
+        self._entries[id(annotation)] = (annotation, cells)
+
+    def remove(self, annotation):
+        entry = self._entries.pop(id(annotation), None)
+        if entry is None:
+            return
+        for cell in entry[1]:
+            bucket = self._cells[cell]
+            bucket[:] = [a for a in bucket if a is not annotation]
+            if not bucket:
+                del self._cells[cell]
+
+    def sync(self, annotations):
+        # Brings the index in line with the image's current list (after undo,
+        # redo or a new mask) without rebuilding what did not change
+        current = {id(a): a for a in annotations}
+        for key in [key for key in self._entries if key not in current]:
+            self.remove(self._entries[key][0])
+        for key, annotation in current.items():
+            if key not in self._entries:
+                self.add(annotation)
+
+    def query_box(self, x0, y0, x1, y1):
+        found = {}
+        cols, rows = self._cell_range(x0, y0, x1, y1)
+        if len(cols) * len(rows) > len(self._cells):
+            # Box larger than the populated area: walking the occupied cells is cheaper
+            cells = [cell for cell in self._cells if cell[0] in cols and cell[1] in rows]
+        else:
+            cells = [(cx, cy) for cx in cols for cy in rows]
+        for cell in cells:
+            for annotation in self._cells.get(cell, ()):
+                bx0, by0, bx1, by1 = annotation.bbox
+                if bx0 <= x1 and bx1 >= x0 and by0 <= y1 and by1 >= y0:
+                    found[id(annotation)] = annotation
+        return list(found.values())
+
+    def query_point(self, x, y):
+        """Annotations containing (x, y), smallest first (the innermost one is usually meant)."""
+        cell = (int(x // self.cell_size), int(y // self.cell_size))
+        hits = []
+        for annotation in self._cells.get(cell, ()):
+            bx0, by0, bx1, by1 = annotation.bbox
+            if bx0 <= x <= bx1 and by0 <= y <= by1 and contains_point(annotation, x, y):
+                hits.append(annotation)
+        hits.sort(key=lambda a: a.area)
+        return hits
+
+    def overlaps(self, annotation, min_iou=0.0):
+        """[(indexed annotation, IoU)] for every annotation overlapping this one with
+        IoU >= min_iou, highest IoU first."""
+        results = []
+        for other in self.query_box(*annotation.bbox):
+            if other is annotation:
+                continue
+            # Rasterizing is the expensive part; most neighbours are ruled out without it
+            if min_iou > 0 and iou_upper_bound(annotation, other) < min_iou:
+                continue
+            iou = mask_iou(annotation, other)
+            if iou > 0 and iou >= min_iou:
+                results.append((other, iou))
+        results.sort(key=lambda r: r[1], reverse=True)
+        return results
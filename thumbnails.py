@@ -0,0 +1,103 @@
+# thumbnails.py (background thumbnail generation with an on-disk cache, for the image browser)
+import os
+import queue
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from embedding_cache import image_cache_key
+
+THUMBNAIL_SIZE = 96
+THUMBNAIL_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "smart_annotator", "thumbnails")
+
+
+def make_thumbnail(image_path, size=THUMBNAIL_SIZE):
+    with Image.open(image_path) as img:
+        # JPEG can decode straight at a fraction of full size, which is most of the speedup
+        img.draft('RGB', (size, size))
+        img = img.convert('RGB')
+        img.thumbnail((size, size))
+        return img
+
+
+class ThumbnailCache:
+    """Thumbnails by image path: memory LRU, then disk, then a worker pool.
+
+    get() never blocks. A miss schedules generation and returns None. Paths
+    that finished since the last call come back from poll(), which is meant
+    to be called from the Tk thread. Disk entries are keyed by path, mtime and
+    size (image_cache_key), so an edited image gets a fresh thumbnail.
+    """
+
+    def __init__(self, cache_dir=THUMBNAIL_CACHE_DIR, size=THUMBNAIL_SIZE, workers=4, max_entries=512):
+        self.cache_dir = cache_dir
+        self.size = size
+        self.max_entries = max_entries
+        os.makedirs(cache_dir, exist_ok=True)
+        self._memory = OrderedDict()
+        self._queued = set()
+        self._wanted = set()
+        self._failed = set()
+        self._done = queue.Queue()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbnail")
+
+    def get(self, image_path):
+        with self._lock:
+            thumbnail = self._memory.get(image_path)
+            if thumbnail is not None:
+                self._memory.move_to_end(image_path)
+                return thumbnail
+            if image_path not in self._queued and image_path not in self._failed:
+                self._queued.add(image_path)
+                self._pool.submit(self._load, image_path)
+        return None
+
+    def set_wanted(self, image_paths):
+        # Queued work for rows that scrolled out of view is skipped when its turn comes
+        with self._lock:
+            self._wanted = set(image_paths)
+
+    def poll(self):
+        ready = []
+        while True:
+            try:
+                ready.append(self._done.get_nowait())
+            except queue.Empty:
+                return ready
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _disk_path(self, image_path):
+        key = f"{image_cache_key(image_path)}:{self.size}"
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".jpg")
+
+    def _load(self, image_path):
+        with self._lock:
+            if image_path not in self._wanted:
+                self._queued.discard(image_path)
+                return
+        thumbnail = None
+        try:
+            disk_path = self._disk_path(image_path)
+            if os.path.exists(disk_path):
+                with Image.open(disk_path) as img:
+                    thumbnail = img.convert('RGB')
+            else:
+                thumbnail = make_thumbnail(image_path, self.size)
+                thumbnail.save(disk_path + ".tmp", "JPEG", quality=85)
+                os.replace(disk_path + ".tmp", disk_path)
+        except Exception as e:
+            print(f"Thumbnail failed for {image_path}: {e}")
+        with self._lock:
+            self._queued.discard(image_path)
+            if thumbnail is None:
+                self._failed.add(image_path)
+            else:
+                self._memory[image_path] = thumbnail
+                while len(self._memory) > self.max_entries:
+                    self._memory.popitem(last=False)
+        if thumbnail is not None:
+            self._done.put(image_path)
@@ -0,0 +1,257 @@
+# tiled_inference.py (SAM on very large images: only the tiles around a click are encoded)
+import os
+import math
+import hashlib
+import tempfile
+import threading
+import cv2
+import numpy as np
+from PIL import Image
+from sam_integration import generate_masks
+from embedding_cache import image_cache_key
+from annotation_processing import Annotation, mask_to_annotation
+from image_cache import ImagePyramid, open_unchecked
+
+# Images whose longer side is above this are segmented tile by tile instead of
+# being downscaled to the encoder's 1024 pixel input as a whole
+TILED_MIN_SIDE = 4096
+TILE_SIZE = 1024
+TILE_OVERLAP = 256
+# Tiles merged into one mask at most (the clicked tile plus neighbours)
+MAX_MERGED_TILES = 9
+TILE_CACHE_DIR = os.path.join(tempfile.gettempdir(), "smart_annotator_tiles")
+# Decoded pixel caches take 3 bytes per pixel; the least recently used ones are
+# deleted once the cache directory grows past this
+TILE_CACHE_BYTES = 4 * 1024 * 1024 * 1024
+DECODE_STRIP_ROWS = 512
+# Longer side of the in-memory downscaled copy used to display zoomed-out views
+OVERVIEW_SIDE = 4096
+
+
+def needs_tiling(size):
+    return max(size) > TILED_MIN_SIDE
+
+
+def tile_origins(length):
+    # Evenly strided tiles with the last one flush with the image edge, so
+    # neighbouring tiles always overlap by at least TILE_OVERLAP
+    if length <= TILE_SIZE:
+        return [0]
+    origins = list(range(0, length - TILE_SIZE, TILE_SIZE - TILE_OVERLAP))
+    origins.append(length - TILE_SIZE)
+    return origins
+
+
+def prune_tile_cache(cache_dir=TILE_CACHE_DIR, max_bytes=TILE_CACHE_BYTES, keep=()):
+    # Least recently used first; pixels() touches the file's mtime on every open
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(".npy"):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path in keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue  # still mapped by another process (Windows)
+        total -= size
+
+
+def interior_point(region):
+    # Mask pixel farthest from the region's edges - a prompt SAM cannot miss
+    padded = cv2.copyMakeBorder(region.astype(np.uint8), 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+    distance = cv2.distanceTransform(padded, cv2.DIST_L2, 3)
+    y, x = np.unravel_index(np.argmax(distance), distance.shape)
+    return x - 1, y - 1
+
+
+class TiledImage:
+    """A large image read through an on-disk pixel cache, one tile at a time.
+
+    The image is decoded once into an .npy file in cache_dir (keyed by path,
+    mtime and size) and memory-mapped afterwards, so a tile costs a slice read
+    instead of a full decode. The directory is kept under max_bytes by
+    deleting the least recently used files. Tile embeddings are cached under
+    per-tile keys.
+    """
+
+    def __init__(self, image_path, cache_dir=TILE_CACHE_DIR, max_bytes=TILE_CACHE_BYTES):
+        self.image_path = image_path
+        self.key = image_cache_key(image_path)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        with open_unchecked(image_path) as img:
+            self.size = img.size
+        self.xs = tile_origins(self.size[0])
+        self.ys = tile_origins(self.size[1])
+        self._pixels = None
+        self._lock = threading.Lock()
+
+    def pixels(self):
+        with self._lock:
+            if self._pixels is None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                path = os.path.join(self.cache_dir, hashlib.sha1(self.key.encode("utf-8")).hexdigest() + ".npy")
+                if os.path.exists(path):
+                    os.utime(path)
+                else:
+                    self._decode(path)
+                self._pixels = np.load(path, mmap_mode="r")
+                prune_tile_cache(self.cache_dir, self.max_bytes, keep={path})
+            return self._pixels
+
+    def _decode(self, path):
+        # Converted to RGB strip by strip, so only the decoder's own buffer is
+        # ever held in memory at full size
+        w, h = self.size
+        tmp_path = path + ".tmp"
+        # Aerial and microscopy images are well above PIL's decompression bomb
+        # limit, which is only lifted for images that are meant to be tiled
+        opener = open_unchecked if needs_tiling(self.size) else Image.open
+        with opener(self.image_path) as img:
+            out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8, shape=(h, w, 3))
+            for y in range(0, h, DECODE_STRIP_ROWS):
+                y1 = min(h, y + DECODE_STRIP_ROWS)
+                out[y:y1] = np.asarray(img.crop((0, y, w, y1)).convert("RGB"))
+            out.flush()
+            del out
+        os.replace(tmp_path, path)
+
+    def tile_box(self, i, j):
+        x0, y0 = self.xs[i], self.ys[j]
+        return x0, y0, min(x0 + TILE_SIZE, self.size[0]), min(y0 + TILE_SIZE, self.size[1])
+
+    def tile_for_point(self, x, y):
+        # The tile whose centre is nearest, which keeps the click away from tile edges
+        i = int(np.argmin(np.abs(np.asarray(self.xs) + TILE_SIZE / 2 - x)))
+        j = int(np.argmin(np.abs(np.asarray(self.ys) + TILE_SIZE / 2 - y)))
+        return i, j
+
+    def tile_key(self, i, j):
+        x0, y0, _, _ = self.tile_box(i, j)
+        return f"{self.key}#tile:{x0},{y0}"
+
+    def load_tile(self, i, j):
+        x0, y0, x1, y1 = self.tile_box(i, j)
+        return np.ascontiguousarray(self.pixels()[y0:y1, x0:x1])
+
+    def _neighbour_prompts(self, i, j, mask):
+        # For every edge the mask touches, a prompt for the tile across that
+        # edge, placed on the mask inside the strip both tiles share
+        x0, y0, x1, y1 = self.tile_box(i, j)
+        edges = [((i - 1, j), mask[:, 0].any()), ((i + 1, j), mask[:, -1].any()),
+                 ((i, j - 1), mask[0].any()), ((i, j + 1), mask[-1].any())]
+        for (ni, nj), touches in edges:
+            if not touches or not (0 <= ni < len(self.xs) and 0 <= nj < len(self.ys)):
+                continue
+            nx0, ny0, nx1, ny1 = self.tile_box(ni, nj)
+            ox0, oy0 = max(x0, nx0) - x0, max(y0, ny0) - y0
+            ox1, oy1 = min(x1, nx1) - x0, min(y1, ny1) - y0
+            shared = mask[oy0:oy1, ox0:ox1]
+            if shared.any():
+                px, py = interior_point(shared)
+                yield (ni, nj), (x0 + ox0 + px, y0 + oy0 + py)
+
+    def segment(self, predictor, points, labels, cache=None, mask_options=None):
+        """Click points (full-image coordinates) -> (annotation, vertices before, after).
+
+        The annotation is in full-image coordinates; None if SAM found nothing.
+        Masks reaching a tile edge are grown into the neighbouring tile by
+        prompting it with a point on the mask, and the tile masks are merged.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        labels = np.asarray(labels)
+        masks = {}
+        queue = [(self.tile_for_point(*points[0]), points, labels)]
+        while queue and len(masks) < MAX_MERGED_TILES:
+            (i, j), tile_points, tile_labels = queue.pop(0)
+            if (i, j) in masks:
+                continue
+            x0, y0, x1, y1 = self.tile_box(i, j)
+            result = generate_masks(predictor, lambda i=i, j=j: self.load_tile(i, j),
+                                    tile_points - (x0, y0), tile_labels, cache, self.tile_key(i, j))
+            if result is None or len(result) == 0 or not result[0].any():
+                continue
+            masks[(i, j)] = result[0]
+            for (ni, nj), point in self._neighbour_prompts(i, j, result[0]):
+                if (ni, nj) in masks:
+                    continue
+                # The user's own clicks still apply where they fall inside the neighbour
+                nx0, ny0, nx1, ny1 = self.tile_box(ni, nj)
+                inside = ((points[:, 0] >= nx0) & (points[:, 0] < nx1) &
+                          (points[:, 1] >= ny0) & (points[:, 1] < ny1))
+                queue.append(((ni, nj), np.vstack([[point], points[inside]]),
+                              np.concatenate([[1], labels[inside]])))
+        if not masks:
+            return None, 0, 0
+
+        boxes = [self.tile_box(i, j) for i, j in masks]
+        X0, Y0 = min(b[0] for b in boxes), min(b[1] for b in boxes)
+        X1, Y1 = max(b[2] for b in boxes), max(b[3] for b in boxes)
+        merged = np.zeros((Y1 - Y0, X1 - X0), dtype=bool)
+        for (x0, y0, x1, y1), mask in zip(boxes, masks.values()):
+            merged[y0 - Y0:y1 - Y0, x0 - X0:x1 - X0] |= mask
+        annotation, before, after = mask_to_annotation(merged, **(mask_options or {}))
+        offset = (X0, Y0)
+        annotation = Annotation([c + offset for c in annotation.contours], annotation.class_id,
+                                holes=[c + offset for c in annotation.holes])
+        return annotation, before, after
+
+
+class TiledPyramid:
+    """Display source for a TiledImage, with the same render() as ImagePyramid.
+
+    Zoomed-out views come from a downscaled copy (longer side OVERVIEW_SIDE at
+    most) held in memory; closer views are read from the memory-mapped pixels,
+    only for the visible region and with a row/column stride matching the zoom.
+    Nothing is rendered until load() has run, which decodes the pixel cache the
+    first time an image is seen and is meant for a background thread.
+    """
+
+    def __init__(self, tiled_image, overview_side=OVERVIEW_SIDE):
+        self.tiled_image = tiled_image
+        self.size = tiled_image.size
+        self.step = max(1, math.ceil(max(self.size) / overview_side))
+        self.overview = None
+
+    def load(self):
+        if self.overview is None:
+            pixels = self.tiled_image.pixels()
+            self.overview = ImagePyramid(Image.fromarray(np.ascontiguousarray(pixels[::self.step, ::self.step])))
+        return self
+
+    def render(self, zoom, viewport, fast=False):
+        if self.overview is None:
+            return None, None
+        if zoom * self.step <= 1.0:
+            return self.overview.render(zoom * self.step, viewport, fast)
+        w, h = self.size
+        x0 = max(0, int(math.floor(viewport[0])))
+        y0 = max(0, int(math.floor(viewport[1])))
+        x1 = min(int(w * zoom), int(math.ceil(viewport[2])))
+        y1 = min(int(h * zoom), int(math.ceil(viewport[3])))
+        if x1 <= x0 or y1 <= y0:
+            return None, None
+
+        # Source pixels under the viewport; a stride keeps the read about the size of the screen
+        stride = max(1, int(1.0 / zoom)) if fast else max(1, int(0.5 / zoom))
+        sx0, sy0 = int(x0 / zoom), int(y0 / zoom)
+        sx1, sy1 = min(w, int(math.ceil(x1 / zoom)) + 1), min(h, int(math.ceil(y1 / zoom)) + 1)
+        region = Image.fromarray(np.ascontiguousarray(
+            self.tiled_image.pixels()[sy0:sy1:stride, sx0:sx1:stride]))
+        box = ((x0 / zoom - sx0) / stride, (y0 / zoom - sy0) / stride,
+               min(region.width, (x1 / zoom - sx0) / stride), min(region.height, (y1 / zoom - sy0) / stride))
+        resample = Image.BILINEAR if fast else Image.LANCZOS
+        if fast and zoom >= 1.0:
+            resample = Image.NEAREST
+        return region.resize((x1 - x0, y1 - y0), resample, box=box), (x0, y0)
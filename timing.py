@@ -0,0 +1,100 @@
+# timing.py (per-stage timers for the click -> mask -> polygon -> export pipeline)
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger("smart_annotator.timing")
+
+# Stages shown in the status bar readout, with their short labels
+STATUS_STAGES = [
+    ('image_decode', 'decode'),
+    ('set_image', 'encode'),
+    ('predict', 'predict'),
+    ('create_mask_annotation', 'polygon'),
+    ('preview_render', 'preview'),
+    ('save_state', 'save'),
+]
+
+
+class StageStats:
+    __slots__ = ('count', 'total', 'max', 'last')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+
+class StageTimer:
+    """Collects durations per named stage and writes one JSON log line per measurement.
+
+    Logging goes through the "smart_annotator.timing" logger, which is silent
+    until enable_timing_log() is called; the in-memory stats are always kept.
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, **fields):
+        # The yielded dict can be filled in inside the block (e.g. counts) and is logged with the timing
+        start = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            self.record(name, time.perf_counter() - start, **fields)
+
+    def record(self, name, seconds, **fields):
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = StageStats()
+            stats.count += 1
+            stats.total += seconds
+            stats.max = max(stats.max, seconds)
+            stats.last = seconds
+        if logger.isEnabledFor(logging.INFO):
+            entry = {'stage': name, 'ms': round(seconds * 1000, 3), 'thread': threading.current_thread().name}
+            entry.update(fields)
+            logger.info(json.dumps(entry, default=str))
+
+    def last(self, name):
+        with self._lock:
+            stats = self._stats.get(name)
+            return stats.last if stats is not None else None
+
+    def summary(self):
+        with self._lock:
+            return {name: {'count': s.count, 'mean_ms': s.total / s.count * 1000,
+                           'max_ms': s.max * 1000, 'last_ms': s.last * 1000}
+                    for name, s in self._stats.items()}
+
+    def readout(self, stages=STATUS_STAGES):
+        parts = []
+        for name, label in stages:
+            seconds = self.last(name)
+            if seconds is not None:
+                parts.append(f"{label} {seconds * 1000:.0f}ms")
+        return " | ".join(parts)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+timer = StageTimer()
+stage = timer.stage
+
+
+def enable_timing_log(path=None):
+    # JSON lines to a file, or to stderr without a path
+    handler = logging.FileHandler(path) if path else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    return handler